@@ -0,0 +1,198 @@
+# 2010 atomizer
+"""BBCode clean-up."""
+
+import re
+
+__all__ = ['normalize', 'format_post', 'Formatter', 'NO_NEST']
+
+# no nesting allowed ([b][b]test[/b][/b] -> [b]test[/b])
+NO_NEST = ('b', 'i', 'u', 'color', 'align', 'size')
+
+
+def tag_re(names):
+    """Return a regexp matching opening and closing tags with these names."""
+    return re.compile(r'\[(/?)({0})(?:=([^\]]*))?\]'.format('|'.join(names)))
+
+
+no_nest_re = tag_re(NO_NEST)
+
+
+def normalize(s, names=NO_NEST):
+    """Drop redundant nested tags and empty pairs, in a single pass.
+
+    A tag inside the same tag with the same value ([b][b]x[/b][/b],
+    [color=red][color=red]x[/color][/color]) is dropped along with its
+    closing tag, and so is a tag closed right after it was opened.
+    Tags are matched by name only, so tags left unbalanced by the
+    conversion don't upset the others.
+    """
+    r = no_nest_re if names is NO_NEST else tag_re(names)
+    out = []
+    stacks = dict([(n, []) for n in names])  # name -> [(value, index in out)]
+    pos = 0
+    for m in r.finditer(s):
+        if m.start() > pos:
+            out.append(s[pos:m.start()])
+        pos = m.end()
+        close, name, value = m.groups()
+        stack = stacks[name]
+        if not close:
+            if stack and stack[-1][0] == value:
+                stack.append((value, None))  # redundant
+            else:
+                stack.append((value, len(out)))
+                out.append(m.group())
+        elif not stack:
+            out.append(m.group())
+        else:
+            value, i = stack.pop()
+            if i is None:
+                continue
+            if i == len(out) - 1:
+                out.pop()  # empty pair
+            else:
+                out.append(m.group())
+    out.append(s[pos:])
+    return ''.join(out)
+
+
+# Block tags are put on lines of their own.
+BLOCKS = ('quote', 'spoiler', 'list', 'hr')
+WHITESPACE = ' \t\n\r\f\v'  # what \s matches
+
+
+def format_re(first, *tokens):
+    tokens = [r'(?P<quote>\[/?quote(?:="[^"]*")?\])',
+              r'(?P<spoiler>\[/?spoiler(?:="[^"]*")?\])',
+              r'(?P<list>\[/?list\])',
+              r'(?P<hr>\[hr\])'] + list(tokens)
+    # Don't try every alternative at every position.
+    return re.compile(r'(?=[{0}])(?:{1})'.format(first, '|'.join(tokens)))
+
+
+blocks_re = format_re(r'\[')
+# An item takes the text after it up to the next tag or line end.
+lists_re = format_re(r'\[\n', r'(?P<item>\[\*\][^\[\n]*)', r'(?P<nl>\n)')
+poster_re = re.compile(r'\[img[^\]]*\]')
+
+
+class Formatter(object):
+    """Single-pass BBCode formatter.
+
+    format() does at once what used to be several passes over the post:
+    -- poster fix: the first image floats to the right (if poster is
+       set, or the post starts with an image);
+    -- list fix: if there is no [list], every line with [*] items is
+       made a list, and adjacent lists are joined;
+    -- block tags (quote, spoiler, list, hr) are put on lines of their
+       own, the whitespace around them is dropped, and a blank line
+       separates two adjacent tags of the same kind;
+    -- every line is stripped, as the text between block tags is
+       placed (the lines with a block tag have nothing to strip).
+    After format(), poster_fixed and list_lines tell what was done.
+    """
+    def __init__(self, poster=False):
+        self.poster = poster
+
+    def format(self, s):
+        self.out = []
+        self.run = []  # text after the last block tag, not stripped yet
+        self.pending = []  # whitespace after the last token
+        self.prev = None  # block tag kind, if it was the last token
+        self.poster_fixed = self.poster or s[:5] == '[img]'
+        if self.poster_fixed:
+            m = poster_re.search(s)
+            if m is not None:
+                s = s[:m.start()] + '[img=right]' + s[m.end():]
+        lists = '[list]' not in s and '[*]' in s
+        self.list_lines = 0
+        in_list = False
+        held = None  # whitespace after [/list], if the next list may join it
+        pos = 0
+        for m in (lists_re if lists else blocks_re).finditer(s):
+            kind, tok = m.lastgroup, m.group()
+            t = s[pos:m.start()]
+            pos = m.end()
+            if held is not None:
+                if kind in ('item', 'nl') and not in_list and \
+                        not t.strip(WHITESPACE):
+                    if kind == 'nl':
+                        held += [t, tok]
+                        continue
+                    # [/list] [list] -> nothing
+                    held = None
+                    in_list = True
+                    self.list_lines += 1
+                    self.emit('text', tok)
+                    continue
+                self.close(held)
+                held = None
+            if t:
+                self.emit('text', t)
+            if kind == 'item':
+                if not in_list:
+                    in_list = True
+                    self.list_lines += 1
+                    self.emit('list', '[list]')
+                self.emit('text', tok)
+            elif kind == 'nl':
+                if in_list:
+                    in_list = False
+                    held = [tok]
+                else:
+                    self.emit('ws', tok)
+            elif tok == '[/list]':
+                held = []
+            else:
+                self.emit(kind, tok)
+        if held is not None:
+            self.close(held)
+        if pos < len(s):
+            self.emit('text', s[pos:])
+        if in_list:
+            self.emit('list', '[/list]')
+        if self.prev is None:
+            self.out.append(strip_lines(''.join(self.run + self.pending)))
+        return ''.join(self.out)
+
+    def close(self, held):
+        """Place [/list] and the whitespace held after it."""
+        self.emit('list', '[/list]')
+        self.pending += held
+
+    def emit(self, kind, tok):
+        """Place a token, dropping whitespace around block tags."""
+        if kind == 'ws' or kind == 'text' and not tok.strip(WHITESPACE):
+            self.pending.append(tok)
+            return
+        if kind in BLOCKS:
+            if self.prev is None:
+                # the line break before the block tag ends the last line
+                s = ''.join(self.run).rstrip(WHITESPACE) + '\n'
+                self.out.append(strip_lines(s))
+                self.run = []
+            if '"' in tok:
+                # a quoted title may span lines
+                tok = strip_lines(tok)
+            self.out += ['\n\n' if self.prev == kind else '\n', tok]
+            self.prev = kind
+        elif self.prev is not None:
+            self.out.append('\n')
+            self.run.append(tok.lstrip(WHITESPACE))
+            self.prev = None
+        elif self.pending:
+            self.run += self.pending
+            self.run.append(tok)
+        else:
+            self.run.append(tok)
+        del self.pending[:]
+
+
+def strip_lines(s):
+    """Strip every line of s."""
+    return '\n'.join([x.strip() for x in s.splitlines()])
+
+
+def format_post(s, poster=False):
+    """Format BBCode in a single pass, see Formatter."""
+    return Formatter(poster).format(s)
@@ -0,0 +1,507 @@
+#!/usr/bin/python
+# 2010 atomizer
+"""Micro-benchmarks for getbb internals.
+
+Each benchmark compares the current code with a straightforward version
+of what it replaced. Run without arguments to run all of them.
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import socket
+import argparse
+import tempfile
+import threading
+import urllib2
+from cStringIO import StringIO
+from timeit import Timer
+
+import getbb
+import rules
+import bbcode
+import linkcache
+import rehost
+import encode
+import streaminghttp
+
+# Typical attribute strings found in rutracker/hdclub posts.
+SAMPLE_ATTRS = (
+    ' class="post-b"',
+    ' style="color: #0000FF;"',
+    ' style="font-size: 18px; line-height: normal;"',
+    ' class="postImg postImgAligned img-right" title="http://i.fastpic.ru/big/a.jpg"',
+    ' class="postImg" title="http://i.fastpic.ru/big/b.jpg"',
+    ' href="http://fastpic.ru/view/2010/c.jpg.html" class="postLink"',
+    ' class="sp-wrap"',
+    ' class="sp-head folded"',
+    ' class="sp-body" title="Screenshots"',
+    ' style="text-align: center;"',
+    ' class="q" head="user"',
+    ' class="post-br"',
+    '',
+    ' id="p-12345"',
+    ' class="sp-fold"',
+    ' src="http://img.example.com/d.png" alt="pic"',
+)
+
+
+def timeit(f, number):
+    """Return the best time of a single call of f, in microseconds."""
+    return min(Timer(f).repeat(3, number)) / number * 1e6
+
+
+def report(name, before, after, unit='us'):
+    print('{0:<32} {1:>10.2f} {3} {2:>10.2f} {3} {4:>7.1f}x'.format(
+        name, before, after, unit, before / after))
+
+
+def bench_rules():
+    """Per-tag cost of skip/complex rule lookup, per-post cost of simple rules."""
+    rs = rules.for_host('')
+    data = rs.data
+
+    def naive_tag(attr):
+        for t in data['skip_attr']:
+            if re.search(t, attr):
+                return None
+        for (i, op, cl) in data['complex']:
+            dm = re.search(rules.FLAGS + i, attr)
+            if dm is not None:
+                return (op, cl), dm
+        return None, None
+
+    def indexed_tag(attr):
+        if rs.skip_attr_re.search(attr):
+            return None
+        return rs.complex.match(attr)
+
+    def cold_tag(attr):
+        rs.complex.memo.clear()
+        return indexed_tag(attr)
+
+    n = len(SAMPLE_ATTRS)
+    before = timeit(lambda: [naive_tag(a) for a in SAMPLE_ATTRS], 2000) / n
+    cold = timeit(lambda: [cold_tag(a) for a in SAMPLE_ATTRS], 2000) / n
+    warm = timeit(lambda: [indexed_tag(a) for a in SAMPLE_ATTRS], 2000) / n
+    report('tag rule lookup', before, cold)
+    report('tag rule lookup (repeated attr)', before, warm)
+
+    post = ''.join(['<div class="sp-wrap"><div class="sp-head">Screens</div>'
+                    '<div class="sp-body"><ul><li>a<br>b</li></ul>'
+                    '<!-- comment --><b>bold</b><img src="x{0}.jpg"><hr>'
+                    '</div></div>\n'.format(i) for i in range(50)])
+
+    def naive_post():
+        s = post
+        for t in data['skip_tags']:
+            s = re.sub(rules.FLAGS + '\s*<(?P<tag>' + t +
+                       ').*?</(?P=tag)>\s*', '', s)
+        for (k, r) in data['simple']:
+            s = re.sub(rules.FLAGS + k, r, s)
+        for t in data['closed_tags']:
+            s = re.sub(rules.FLAGS + r'<({0}[^>]*?)/?>'.format(t), r'<\1/>', s)
+            s = s.replace('</{0}>'.format(t), '')
+        return s
+
+    def fused_post():
+        s = post
+        for r in rs.skip_tags:
+            s = r.sub('', s)
+        for r, repl in rs.simple:
+            s = r.sub(repl, s)
+        s = rs.closed_re.sub(r'<\1/>', s)
+        return rs.unclosed_re.sub('', s)
+
+    assert naive_post() == fused_post()
+    report('simple rules (50 blocks)', timeit(naive_post, 50),
+           timeit(fused_post, 50))
+
+
+def bench_posts():
+    """Extracting the first post of a big topic page."""
+    post = ('<div class="post_body"><span class="post-b">Post</span> text'
+            '<br>' + 'lorem ipsum dolor sit amet ' * 60 +
+            '</div><!--/post_body-->\n')
+    topic = u'<html><body>' + post * 500 + u'</body></html>'  # ~1 MB
+    comment = post.replace('post_body', 'comment')
+    tbdev = u'<html><body>' + comment * 500 + u'>' + u'0' * 40 + \
+        u'</td></tr>' + comment + u'<a name="startcomments">'
+    c = getbb.Converter()
+
+    def naive(page):
+        for p in c.rules.posts:
+            m = p.findall(page)
+            if len(m) > 0:
+                return m[:c.count]
+        return [page]
+
+    for (name, page) in (('first post (1 MB TorrentPier)', topic),
+                         ('first post (1 MB TBDev)', tbdev)):
+        assert naive(page) == c.extract_posts(page)
+        report(name, timeit(lambda: naive(page), 5) / 1000,
+               timeit(lambda: c.extract_posts(page), 5) / 1000, 'ms')
+
+
+def bench_read():
+    """Reading a big saved page and extracting its first post."""
+    post = (u'<div class="post_body"><span class="post-b">\u041f\u043e\u0441\u0442'
+            u'</span><br>' + u'\u0442\u0435\u043a\u0441\u0442 lorem ipsum ' * 60 +
+            u'</div><!--/post_body-->\n')
+    page = (u'<html><head><meta charset="windows-1251"></head><body>' +
+            post * 2000 + u'</body></html>').encode('cp1251')  # ~4 MB
+    fd, name = tempfile.mkstemp('.html')
+    os.write(fd, page)
+    os.close(fd)
+    c = getbb.Converter(name, verbose=False)
+
+    def naive():
+        with open(name, 'rb') as f:
+            s = f.read().decode('cp1251')
+        for p in c.rules.posts:
+            m = p.findall(s)
+            if len(m) > 0:
+                return m[:c.count]
+        return [s]
+
+    try:
+        assert naive() == c.extract_posts(c.read())
+        report('first post (4 MB file)', timeit(naive, 5) / 1000,
+               timeit(lambda: c.extract_posts(c.read()), 5) / 1000, 'ms')
+    finally:
+        os.unlink(name)
+
+
+def bench_restore():
+    """Putting URLs back in place of their hashes."""
+    for n in (10, 100, 1000):
+        urls = dict([(getbb.hashurl(u'http://i.fastpic.ru/big/{0}.jpg'.format(i)),
+                      u'http://file.kirovnet.ru/d/{0}'.format(i)) for i in range(n)])
+        post = u''.join([u'[url={0}][img]{0}[/img][/url] Screenshot 0x1080p\n'.format(h)
+                         for h in urls])
+
+        def naive():
+            s = post
+            for p in urls:
+                s = s.replace(p, urls[p])
+            return s
+
+        assert naive() == getbb.replace_hashes(post, urls)
+        report('restore ({0} images)'.format(n), timeit(naive, 5),
+               timeit(lambda: getbb.replace_hashes(post, urls), 5))
+
+
+def bench_nest():
+    """No-nesting rule: regexps per tag vs a single pass per post."""
+    def reduce_nest(code, left, right, srcleft, srcright):
+        # the old per-tag version
+        L = '{#L#}'; R = '{#R#}'
+        opt = left.replace('[', L).replace(']', R)
+        clt = right.replace('[', L).replace(']', R)
+        sl = srcleft.replace('[', r'\[').replace(']', r'\]')
+        sr = srcright.replace('[', r'\[').replace(']', r'\]')
+        sl = sl.replace('_', r'[^\]]+')
+        code = re.sub(rules.FLAGS + r'((\[[^/\]]+\])*' + sl + ')', clt + r'\1', code)
+        code = re.sub(rules.FLAGS + '(' + sr + r'(\[/[^\]]+\])*)', r'\1' + opt, code)
+        code = code.replace(L, '[').replace(R, ']')
+        return (left + code + right).replace(left + right, '')
+
+    tags = {'b': ('[b]', '[/b]'), 'i': ('[color=_]', '[/color]'),
+            'u': ('[u]', '[/u]'), 'a': ('[url=_]', '[/url]')}
+
+    def old_tag(tag, attr, dc):
+        op, cl = tags[tag]
+        if tag == 'a':
+            return op.replace('_', 'x') + dc + cl
+        return reduce_nest(dc, op.replace('_', 'red'), cl, op, cl)
+
+    def new_tag(tag, attr, dc):
+        op, cl = tags[tag]
+        return op.replace('_', 'red' if tag == 'i' else 'x') + dc + cl
+
+    post = ('<b>Title <i>red <b>bold</b></i> <u>x<a>link <b>y</b></a></u></b>'
+            '<i><i>z</i></i><b></b>text\n') * 100
+    report('no-nest rule (100 blocks)',
+           timeit(lambda: getbb.walk_tags(post, old_tag), 20),
+           timeit(lambda: bbcode.normalize(getbb.walk_tags(post, new_tag)[0]), 20))
+
+
+def bench_format():
+    """Post-processing a 50-post output (poster, lists, block tags)."""
+    post = ('[img]http://file.kirovnet.ru/d/1[/img] [b]Title[/b]\n'
+            '[spoiler="Info"] Year: 2010\nGenre: drama \n[/spoiler][hr]'
+            '[quote]text  [/quote]\n  lorem ipsum [url=x]y[/url]\n') * 4
+    items = post.replace('Year', '[*]Year').replace('Genre', '[*]Genre')
+
+    def naive(s):
+        s = re.sub(r'\[img[^]]*\]', r'[img=right]', s, 1)
+        if '[list]' not in s and '[*]' in s:
+            s, n = re.subn(r'(\[\*\].*)', r'[list]\1[/list]', s)
+            if n > 0:
+                s = re.sub(r'\[/list\]\s*\[list\]', '', s)
+        surround = ('/?quote(="[^"]*")?', '/?spoiler(="[^"]*")?', '/?list', 'hr')
+        for t in surround:
+            s = re.sub(r'\s*(\[' + t + r'\])\s*', r'\n\1\n', s)
+        return '\n'.join([x.strip() for x in s.splitlines()])
+
+    for (name, p) in (('postprocess (50 posts)', post),
+                      ('postprocess (50 posts, lists)', items)):
+        out = '\n\n'.join([p] * 50)
+        assert naive(out) == bbcode.format_post(out)
+        report(name, timeit(lambda: naive(out), 5) / 1000,
+               timeit(lambda: bbcode.format_post(out), 5) / 1000, 'ms')
+
+
+def bench_cache():
+    """Link cache lookups: scanning linkcache.txt vs the indexed cache."""
+    n = 50000
+    fd, legacy = tempfile.mkstemp('.txt')
+    os.write(fd, ''.join(['http://i.fastpic.ru/big/{0}.jpg\t'
+                          'http://file.kirovnet.ru/d/{0}\n'.format(i)
+                          for i in range(n)]))
+    os.close(fd)
+    db = legacy + '.db'
+    keys = ['http://i.fastpic.ru/big/{0}.jpg'.format(i)
+            for i in range(0, n, n // 20)] + ['http://example.org/missing.jpg']
+
+    def naive(address):
+        # the old rehost.cache_search()
+        with open(legacy, 'a+') as cf:
+            for cs in cf:
+                try:
+                    sl, fl = cs.strip().split()[:2]
+                    if sl == address:
+                        return fl
+                except ValueError:
+                    pass
+        return None
+
+    try:
+        c = linkcache.LinkCache(db, legacy)
+        assert [naive(k) for k in keys] == [c.get(k) for k in keys]
+        before = timeit(lambda: [naive(k) for k in keys], 1) / len(keys)
+
+        def cold():
+            c.hot.clear()
+            return [c.get(k) for k in keys]
+
+        report('link cache lookup (50k links)', before,
+               timeit(cold, 100) / len(keys))
+        report('link cache lookup (hot)', before,
+               timeit(lambda: [c.get(k) for k in keys], 100) / len(keys))
+    finally:
+        os.unlink(legacy)
+        os.unlink(db)
+
+
+def bench_rewrite():
+    """Direct link recovery rules for 3000 image URLs of various hosts."""
+    urls = []
+    for i in range(250):
+        h = '{0:032x}'.format(i * 7919)
+        urls += [
+            'http://fastpic.ru/view/7/2010/0616/{0}.jpg.html'.format(h),
+            'http://i7.fastpic.ru/big/2010/0616/15/{0}.jpg'.format(h),
+            'http://s{0:03}.radikal.ru/i/{1}.jpg.html'.format(i % 60, h),
+            'http://radikal.ru/F/s{0:03}.radikal.ru/i/{1}.jpg.html'.format(i % 60, h),
+            'http://iceimg.com/{0}.png.htm'.format(h[:14]),
+            'http://picsee.net/2011-06-02/{0}.jpg.html'.format(h[:12]),
+            'http://www.ag.ru/screenshots/game_{0}/{1}'.format(i % 40, i),
+            'http://imageban.ru/show/2010/10/20/{0}/jpg'.format(h),
+            'http://img{0}.imageshack.us/i/{1}.jpg/'.format(i % 900, h[:8]),
+            'http://img.phyrefile.com/hdlover/2009/12/09/{0}.png'.format(i),
+            'http://pic.example.org/{0}.jpg'.format(h),
+            'http://i{0}.photobucket.com/albums/{1}.png'.format(i % 20, h),
+        ]
+
+    def naive(url):
+        # the old recover_image(), up to fetching the page
+        for (L, R, C) in rehost.RW:
+            dlink = re.sub(L, R, url)
+            if dlink != url:
+                if C == 0:
+                    return (dlink, True)
+                else:
+                    url = dlink
+                    break
+        for (L, R) in rehost.RW_EXT:
+            if re.search(L, url) is not None:
+                return (url, False)
+        return (url, True)
+
+    assert [naive(u) for u in urls] == [rehost.rewrite_url(u) for u in urls]
+    report('rewrite rules (per URL)', timeit(lambda: [naive(u) for u in urls], 5) / len(urls),
+           timeit(lambda: [rehost.rewrite_url(u) for u in urls], 5) / len(urls))
+
+
+class _Sink(object):
+    """A local HTTP server that reads request bodies and answers "ok"."""
+
+    def __init__(self):
+        self.ls = socket.socket()
+        self.ls.bind(('127.0.0.1', 0))
+        self.ls.listen(5)
+        self.address = self.ls.getsockname()
+        self.url = 'http://{0}:{1}/upload'.format(*self.address)
+        self.received = []  # body bytes left unread, 0 for each request
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        buf = bytearray(2 ** 18)
+        while True:
+            c = self.ls.accept()[0]
+            head = ''
+            while '\r\n\r\n' not in head:
+                head += c.recv(4096)
+            if head.startswith('QUIT'):
+                c.close()
+                return
+            head, body = head.split('\r\n\r\n', 1)
+            left = int(re.search(r'(?i)content-length: *(\d+)', head).group(1))
+            left -= len(body)
+            while left > 0:
+                left -= c.recv_into(buf)
+            self.received.append(left)
+            c.sendall('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n'
+                      'Connection: close\r\n\r\nok')
+            c.close()
+
+    def close(self):
+        socket.create_connection(self.address).sendall('QUIT\r\n\r\n')
+        self.thread.join()
+        self.ls.close()
+        assert self.received and not any(self.received)
+
+
+def bench_upload():
+    """Uploading a 50 MB file: read() and send() in blocks vs sendfile()."""
+    if streaminghttp._sendfile is None:
+        print('upload: no sendfile() here, skipped')
+        return
+    size = 50 * 2 ** 20
+    f = tempfile.TemporaryFile()
+    block = os.urandom(2 ** 16)
+    for i in range(size // len(block)):
+        f.write(block)
+    f.flush()
+    sink = _Sink()
+    opener = streaminghttp.streaming_opener()
+
+    def post(plain):
+        f.seek(0)
+        params = [encode.MultipartParam('file', filename='a.bin', fileobj=f)]
+        if plain:
+            # read and checked in 4 KB blocks, as before
+            body, headers = encode.multipart_encode(
+                params, encode.gen_boundary(), blocksize=4096)
+        else:
+            body, headers = encode.multipart_encode(params)
+        assert opener.open(urllib2.Request(sink.url, body, headers)).read() == 'ok'
+
+    try:
+        report('upload (50 MB file)', timeit(lambda: post(True), 1) * 1e-3,
+               timeit(lambda: post(False), 1) * 1e-3, 'ms')
+    finally:
+        sink.close()
+        f.close()
+
+
+def bench_send():
+    """Uploading 30 small images: a send() per block vs gathered sends."""
+    images = [os.urandom(20000 + 997 * i) for i in range(30)]
+    sink = _Sink()
+    sends = [0]
+
+    class CountingSocket(object):
+        def __init__(self, sock):
+            self.sock = sock
+
+        def sendall(self, *args):
+            sends[0] += 1
+            return self.sock.sendall(*args)
+
+        def __getattr__(self, name):
+            return getattr(self.sock, name)
+
+    def post_all():
+        for data in images:
+            body, headers = encode.multipart_encode([
+                encode.MultipartParam('file', filename='a.png',
+                                      filetype='image/png',
+                                      fileobj=StringIO(data)),
+                ('submit', 'upload')])
+            c = streaminghttp.StreamingHTTPConnection(*sink.address)
+            c.connect()
+            c.sock = CountingSocket(c.sock)
+            c.request('POST', '/upload', body, headers)
+            assert c.getresponse().read() == 'ok'
+            c.close()
+
+    def run(size):
+        streaminghttp.SEND_BUFFER = size
+        sends[0] = 0
+        post_all()
+        calls = sends[0] / float(len(images))
+        return calls, timeit(post_all, 1) * 1e-3
+
+    saved = streaminghttp.SEND_BUFFER
+    try:
+        before = run(0)
+        after = run(saved)
+    finally:
+        streaminghttp.SEND_BUFFER = saved
+        sink.close()
+    report('send calls (per 20 KB upload)', before[0], after[0], 'calls')
+    report('upload (30 x 20 KB)', before[1], after[1], 'ms')
+
+
+def bench_encode():
+    """Encoding a 20 MB file as multipart/form-data."""
+    data = os.urandom(20 * 2 ** 20)
+    boundary = encode.gen_boundary()
+
+    def naive():
+        # the old MultipartParam.iter_encode() loop
+        f = StringIO(data)
+        last_block = ""
+        encoded_boundary = "--%s" % encode.encode_and_quote(boundary)
+        boundary_exp = re.compile("^%s$" % re.escape(encoded_boundary), re.M)
+        while True:
+            block = f.read(4096)
+            if not block:
+                break
+            last_block += block
+            if boundary_exp.search(last_block):
+                raise ValueError("boundary found in file data")
+            last_block = last_block[-len(encoded_boundary)-2:]
+
+    def encoded(check):
+        p = encode.MultipartParam('file', fileobj=StringIO(data))
+        for block in p.iter_encode(boundary, check=check):
+            pass
+
+    before = timeit(naive, 1) / 1000
+    report('file encoding (20 MB)', before, timeit(lambda: encoded(True), 1) / 1000, 'ms')
+    report('file encoding (20 MB, no check)', before,
+           timeit(lambda: encoded(False), 1) / 1000, 'ms')
+
+
+BENCHMARKS = dict((k[6:], v) for (k, v) in globals().items()
+                  if k.startswith('bench_'))
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='Run getbb micro-benchmarks')
+    p.add_argument(
+        'names', metavar='name', nargs='*',
+        help='benchmarks to run: {0} (default: all)'.format(
+            ', '.join(sorted(BENCHMARKS)))
+    )
+    a = p.parse_args()
+    print('{0:<32} {1:>13} {2:>13} {3:>8}'.format(
+        'benchmark', 'before', 'after', 'speedup'))
+    for name in a.names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
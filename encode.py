@@ -7,7 +7,7 @@ multipart/form-data is the standard way to upload files over HTTP"""
 
 __all__ = ['gen_boundary', 'encode_and_quote', 'MultipartParam',
         'encode_string', 'encode_file_header', 'get_body_size', 'get_headers',
-        'multipart_encode']
+        'multipart_encode', 'FileSection']
 
 try:
     import uuid
@@ -22,6 +22,7 @@ except ImportError:
         return sha.new(str(bits)).hexdigest()
 
 import urllib, re, os, sys, mimetypes
+from tempfile import SpooledTemporaryFile
 
 def encode_and_quote(data):
     """If ``data`` is unicode, return urllib.quote_plus(data.encode("utf-8"))
@@ -42,6 +43,32 @@ def _strify(s):
         return s.encode("utf-8")
     return str(s)
 
+def _real_file(fileobj):
+    """Return the file object with a file descriptor behind ``fileobj``,
+    or None"""
+    if isinstance(fileobj, SpooledTemporaryFile):
+        if not fileobj._rolled:
+            return None     # still in memory
+        fileobj = fileobj._file
+    if isinstance(fileobj, file):
+        return fileobj
+    return None
+
+class FileSection(object):
+    """A section of a file to be sent as it is, see
+    :meth:`multipart_yielder.blocks`
+
+    The sender calls ``sent(n)`` as it sends ``n`` more bytes of it."""
+    def __init__(self, fileobj, offset, size):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.size = size
+        self.callbacks = []
+
+    def sent(self, n):
+        for cb in self.callbacks:
+            cb(n)
+
 class MultipartParam(object):
     """Represents a single parameter in a multipart/form-data request
 
@@ -88,6 +115,7 @@ class MultipartParam(object):
         self.filesize = filesize
         self.fileobj = fileobj
         self.cb = cb
+        self._hdr = None    # (boundary, encode_hdr(boundary))
 
         if self.value is not None and self.fileobj is not None:
             raise ValueError("Only one of value or fileobj may be specified")
@@ -171,6 +199,10 @@ class MultipartParam(object):
 
     def encode_hdr(self, boundary):
         """Returns the header of the encoding of this parameter"""
+        # asked for again by get_size() and the encoders, so keep the last
+        if self._hdr is not None and self._hdr[0] == boundary:
+            return self._hdr[1]
+        key = boundary
         boundary = encode_and_quote(boundary)
 
         headers = ["--%s" % boundary]
@@ -198,7 +230,9 @@ class MultipartParam(object):
         headers.append("")
         headers.append("")
 
-        return "\r\n".join(headers)
+        hdr = "\r\n".join(headers)
+        self._hdr = (key, hdr)
+        return hdr
 
     def encode(self, boundary):
         """Returns the string encoding of this parameter"""
@@ -212,10 +246,11 @@ class MultipartParam(object):
 
         return "%s%s\r\n" % (self.encode_hdr(boundary), value)
 
-    def iter_encode(self, boundary, blocksize=4096):
+    def iter_encode(self, boundary, blocksize=65536, check=True):
         """Yields the encoding of this parameter
         If self.fileobj is set, then blocks of ``blocksize`` bytes are read and
-        yielded."""
+        yielded, checking that no line of them starts with the boundary
+        unless ``check`` is false."""
         total = self.get_size(boundary)
         current = 0
         if self.value is not None:
@@ -230,10 +265,11 @@ class MultipartParam(object):
             yield block
             if self.cb:
                 self.cb(self, current, total)
-            last_block = ""
-            encoded_boundary = "--%s" % encode_and_quote(boundary)
-            boundary_exp = re.compile("^%s$" % re.escape(encoded_boundary),
-                    re.M)
+            # look for the boundary after a newline; only the end of the
+            # previous block is kept for matches across blocks
+            needle = "\n--%s" % encode_and_quote(boundary)
+            keep = len(needle) - 1
+            tail = "\n"    # the data starts a line
             while True:
                 block = self.fileobj.read(blocksize)
                 if not block:
@@ -242,15 +278,43 @@ class MultipartParam(object):
                     if self.cb:
                         self.cb(self, current, total)
                     break
-                last_block += block
-                if boundary_exp.search(last_block):
-                    raise ValueError("boundary found in file data")
-                last_block = last_block[-len(encoded_boundary)-2:]
+                if check:
+                    if (tail + block[:keep]).find(needle) >= 0 or \
+                            block.find(needle) >= 0:
+                        raise ValueError("boundary found in file data")
+                    if len(block) >= keep:
+                        tail = block[-keep:]
+                    else:
+                        tail = (tail + block)[-keep:]
                 current += len(block)
                 yield block
                 if self.cb:
                     self.cb(self, current, total)
 
+    def iter_sections(self, boundary, blocksize=65536, check=True):
+        """Yields the encoding of this parameter like iter_encode(), but the
+        data of a real file is yielded as a single :class:`FileSection`,
+        neither read nor checked for the boundary"""
+        f = _real_file(self.fileobj)
+        if f is None or self.filesize is None:
+            for block in self.iter_encode(boundary, blocksize, check):
+                yield block
+            return
+        total = self.get_size(boundary)
+        current = [0]
+        def sent(n):
+            current[0] += n
+            if self.cb:
+                self.cb(self, current[0], total)
+        block = self.encode_hdr(boundary)
+        yield block
+        sent(len(block))
+        section = FileSection(f, f.tell(), self.filesize)
+        section.callbacks.append(sent)
+        yield section
+        yield "\r\n"
+        sent(2)
+
     def get_size(self, boundary):
         """Returns the size in bytes that this param will be when encoded
         with the given boundary."""
@@ -307,10 +371,14 @@ def get_headers(params, boundary):
     return headers
 
 class multipart_yielder:
-    def __init__(self, params, boundary, cb):
+    def __init__(self, params, boundary, cb, check_boundary=True,
+            blocksize=65536):
         self.params = params
         self.boundary = boundary
         self.cb = cb
+        # False if the boundary is known not to be in the data
+        self.check_boundary = check_boundary
+        self.blocksize = blocksize
 
         self.i = 0
         self.p = None
@@ -348,17 +416,45 @@ class multipart_yielder:
             return block
 
         self.p = self.params[self.i]
-        self.param_iter = self.p.iter_encode(self.boundary)
+        self.param_iter = self.p.iter_encode(self.boundary, self.blocksize,
+                self.check_boundary)
         self.i += 1
         return self.next()
 
+    def blocks(self):
+        """Yields the same blocks as iterating does, except that if the
+        boundary needs no checking, the data of real files is yielded as
+        :class:`FileSection` objects, for the caller to send (with
+        sendfile(), for one)"""
+        if self.check_boundary:
+            for block in self:
+                yield block
+            return
+        def sent(p, n):
+            self.current += n
+            if self.cb:
+                self.cb(p, self.current, self.total)
+        for p in self.params:
+            for block in p.iter_sections(self.boundary, self.blocksize,
+                    self.check_boundary):
+                if isinstance(block, FileSection):
+                    # counted as it is sent
+                    block.callbacks.append(lambda n, p=p: sent(p, n))
+                    yield block
+                else:
+                    yield block
+                    sent(p, len(block))
+        block = "--%s--\r\n" % self.boundary
+        yield block
+        sent(None, len(block))
+
     def reset(self):
         self.i = 0
         self.current = 0
         for param in self.params:
             param.reset()
 
-def multipart_encode(params, boundary=None, cb=None):
+def multipart_encode(params, boundary=None, cb=None, blocksize=65536):
     """Encode ``params`` as multipart/form-data.
 
     ``params`` should be a sequence of (name, value) pairs or MultipartParam
@@ -367,10 +463,12 @@ def multipart_encode(params, boundary=None, cb=None):
     the parameter value.  The file-like objects must support .read() and either
     .fileno() or both .seek() and .tell().
 
-    If ``boundary`` is set, then it as used as the MIME boundary.  Otherwise
-    a randomly generated boundary will be used.  In either case, if the
+    If ``boundary`` is set, then it as used as the MIME boundary, and if the
     boundary string appears in the parameter values a ValueError will be
-    raised.
+    raised.  Otherwise a randomly generated boundary will be used, and file
+    data is not searched for it.
+
+    Files are read ``blocksize`` bytes at a time.
 
     If ``cb`` is set, it should be a callback which will get called as blocks
     of data are encoded.  It will be called with (param, current, total),
@@ -400,13 +498,15 @@ def multipart_encode(params, boundary=None, cb=None):
     """
     if boundary is None:
         boundary = gen_boundary()
+        check = False   # a random one is not going to be in the data
     else:
         boundary = urllib.quote_plus(boundary)
+        check = True
 
     headers = get_headers(params, boundary)
     params = MultipartParam.from_params(params)
 
-    return multipart_yielder(params, boundary, cb), headers
+    return multipart_yielder(params, boundary, cb, check, blocksize), headers
 
 # Copyright (c) 2010 Chris AtLee 
 # 
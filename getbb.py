@@ -7,7 +7,17 @@ from __future__ import print_function
 import sys
 import os
 import re
+import stat
+import mmap
+import codecs
+import json
 import argparse
+import multiprocessing
+from itertools import islice
+from contextlib import contextmanager
+from StringIO import StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, UnixStreamServer
 from urlparse import urlparse, urlunparse
 from hashlib import sha1
 
@@ -30,102 +40,35 @@ except ImportError:
 
 import rehost as rehost_m
 from rehost import *
+import rules as rules_m
+import bbcode
 
 FLAGS = '(?si)'
-# self-closed tags
-ntag_re = re.compile(FLAGS +
-    '<(?P<tag>\w+)(?P<attr>[^>]*)(?P<content>)/>')
-# paired tags
-ptag_re = re.compile(FLAGS +
-    '<(?P<tag>\w+)(?P<attr>[^>]*)>(?P<content>[^<]*)</\w+>')
-
-PSTO_PATTERNS = (
-    'class="post_?body"[^>]*>(.*?)(?:</div><!--/post_body|<!-- //bt)',  # rutracker-alike
-    '>[0-9a-f]{40}</td></tr>(.*?)<a name="startcomments">',  # hdclub-alike
-    'class="heading_b"[^>]*>(.*?)</table>',  # hdclub
-    'id="news-id-[^>]*>(.*?)</p>',  # epidemz
-    'id=\'news-id-[^>]*>(.*?)<td class="j"', # very secret site
-)
-SIMPLE_RULES = (
-    ('\n', ''), ('\r', ''), ('<wbr>', ''), (r'<!(\s*--.*?--\s*)*>', ''),
-    ('</?noindex>', ''),
-    # line breaks, horisontal rulers
-    ('<span class="post-br">.*?</span>', '\n\n'),
-    ('<span class="post-hr">.*?</span>', '[hr]'),
-    ('<hr[^>]*>', '[hr]'),
-    ('<br[^>]*>', '\n'),
-    ('<div></div>', '\n'),
-    ('<tr[^>]*>', ''), ('</tr>', '\n'),
-    # lists
-    ('<[ou]l[^>]*>', '[list]'), ('</[ou]l>', '[/list]'),
-    ('<[ou]l type="([^"])">', '[list=\\1]'),
-    ('<li[^>]*>', '[*]'),  ('</li>', ''),
-    # hdclub & epidemz dumb tags
-    ('<b>', '[b]'), ('</b>', '[/b]'),
-    ('<i>', '[i]'), ('</i>', '[/i]'),
-    ('<u>', '[u]'), ('</u>', '[/u]'),
-    # hdclub's textarea
-    ('<textarea>', '[font="monospace"]'),
-    ('</textarea>', '[/font]'),
-    # center, huh
-    ('<center>', '[align=center]'), ('</center>', '[/align]'),
-)
-COMPLEX_RULES = (
-    # simple text formatting
-    ('post-b', ('[b]','[/b]')),
-    ('post-i', ('[i]','[/i]')),
-    ('post-u', ('[u]','[/u]')),
-    ('font-weight: ?bold', ('[b]','[/b]')),
-    ('font-style: ?italic', ('[i]','[/i]')),
-    ('text-decoration: ?underline', ('[u]','[/u]')),
-    ('color: ?([^;"]+)', ('[color=_]', '[/color]')),
-    ('font-size: ?(\d+)', ('[size=_]',  '[/size]')),
-    ('font-family: ?([^;"]+)', ('[font="_"]','[/font]')),
-    # URLs
-    ('href=[\'"]([^\'"]+)', ('[url=_]','[/url]')),
-    # images
-    ('src=[\'"]([^\'"]+)', ('[img]','[/img]')),
-    ('class="postImg" title="([^"]+)', ('[img]','[/img]')),
-    ('class="postImg [^"]*?img-([^ "]*)[^>]*?title="([^"]+)',
-        ('[img=_]','[/img]')),
-    # align
-    ('float: ?(left|right)', ('{#FLOAT#}','')),
-    ('text-align: ?([^;"]+)', ('[align=_]', '[/align]')),
-    (' align="([^"]+)', ('[align=_]', '[/align]')), # hdclub, epidemz
-    # spoilers
-    ('spoiler-wrap', ('{#SP#}','[/spoiler]')), # hdclub, pirat.ca, epidemz(?)
-    ('sp-wrap', ('{#SP#}','[/spoiler]')), # rutracker
-    ('(spoiler-head|sp-head)', ('{#SHS#}','{#SHE#}')),
-    ('sp-body[^>]* title="([^"]+)', ('{#SHS#}_{#SHE#}','')),
-    # quotes
-    ('class="q"', ('[quote]','[/quote]')),
-    ('class="quote"', ('[quote]','[/quote]')),
-    ('class="q" head="([^"]+)', ('[quote="_"]','[/quote]')),
-    # code & pre
-    ('c-body', ('[code]','[/code]')),
-    ('post-pre', ('[font="monospace"]','[/font]')),
-)
+# opening or self-closed tag, closing tag, or a stray '<'
+token_re = re.compile(FLAGS +
+    r'<(?:(?P<tag>\w+)(?P<attr>[^>]*)>|/\w+>)?')
+# what the old element loop matched, see reduce_tags()
+self_closed_re = re.compile(FLAGS +
+    r'<(?P<tag>\w+)(?P<attr>[^>]*)(?P<content>)/>')
+paired_re = re.compile(FLAGS +
+    r'<(?P<tag>\w+)(?P<attr>[^>]*)>(?P<content>[^<]*)</\w+>')
 
-SKIP_TAGS = (
-    'object', 'param', 'embed', 'form',
-    'script', 'style', 'head', 'p', 'noscript',
-)
-SKIP_TAGS_ATTR = (
-    'display: ?none', '"heading"', 'colhead',
-    'sp-fold', 'q-head', 'c-head', 'sp-title', 'quote-title',
-    'attach', 'thx-container', 'tor-fl-wrap',
-)
 TAGS_WITH_URLS = ('a', 'var', 'img',)
-# no nesting allowed ([b][b]test[/b][/b] -> [b]test[/b])
-BBTAGS_NO_NEST = (
-    '[b]', '[i]', '[u]', '[color=_]', '[align=_]', '[size=_]',
-)
-CLOSED_TAGS = (
-    'meta', 'base', 'basefont', 'param', 'frame',
-    'link', 'img', 'br', 'hr', 'area', 'input',
+
+# <meta charset="..."> or <meta http-equiv="Content-Type" content="...; charset=...">
+meta_charset_re = re.compile(
+    r'(?i)<meta[^>]+charset\s*=\s*["\']?([\w.:-]+)')
+non_ascii_re = re.compile(r'[\x80-\xff]')
+BOMS = (
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'),
 )
+CHARSET_SAMPLE = 64 * 2 ** 10
+ASCII_SAMPLE = u''.join(map(unichr, range(32, 127)))
 
 POOL_SIZE = 10
+MAX_REQUEST = 16 * 2 ** 20
 
 THUMB_SIZE = (220, 220)
 thumb_re = re.compile((r'\[url=(?P<url>{0})\].*?\[img\](?P<th>{0})' +
@@ -154,59 +97,353 @@ def hashurl(u):
     return sha1(u.encode('utf-8')).hexdigest()
 
 
-def reduce_nest(code, left, right, srcleft, srcright):
-    L = '{#L#}'; R = '{#R#}'
-    # Hide braces in replacements
-    opt = left.replace('[', L).replace(']', R)
-    clt = right.replace('[', L).replace(']', R)
-    # Escape braces in patterns
-    sl = srcleft.replace('[', r'\[').replace(']', r'\]')
-    sr = srcright.replace('[', r'\[').replace(']', r'\]')
-    sl = sl.replace('_', r'[^\]]+')
-    # Magic!
-    code = re.sub(FLAGS + r'((\[[^/\]]+\])*' + sl + ')', clt + r'\1', code)
-    code = re.sub(FLAGS + '(' + sr + r'(\[/[^\]]+\])*)', r'\1' + opt, code)
-    # Revert braces
-    code = code.replace(L, '[').replace(R, ']')
-    # Empty pairs removal
-    r = (left + code + right).replace(left + right, '')
-    return r
-
-
-def proctag(m):
-    """Return a replacement for single HTML tag."""
-    global urls
-    d = m.groupdict()
-    d['tag'] = d['tag'].lower()
-    for t in SKIP_TAGS_ATTR:
-        if re.search(t, d['attr']):
-            return ''
-    dc = d['content']
+hexrun_re = re.compile('[0-9a-f]{40,}')
+# Below that many hashes, str.replace() for each is faster than a regexp pass.
+FEW_HASHES = 32
+
+
+def replace_hashes(s, urls):
+    """Replace hashes from urls with their URLs.
     
-    # very secret site, fucked up
-    if 'dvdtalk.ru' in site_root:
-        if 'class="z"' in d['attr'] or 'width="190"' in d['attr']:
-            dc = dc.replace('\n', ' ')
-        if d['tag'] == 'span':
-            return '[b]' + dc + '[/b]'
+    Many hashes are replaced in a single pass, instead of a pass per hash.
+    """
+    if len(urls) < FEW_HASHES:
+        for p, url in urls.iteritems():
+            s = s.replace(p, url)
+        return s
+    def repl(m):
+        run = m.group()
+        if len(run) == 40:
+            return urls.get(run, run)
+        # A hash glued to other hex digits.
+        out = []
+        i = last = 0
+        while i <= len(run) - 40:
+            url = urls.get(run[i:i + 40])
+            if url is None:
+                i += 1
+                continue
+            out += [run[last:i], url]
+            i = last = i + 40
+        out.append(run[last:])
+        return ''.join(out)
+    return hexrun_re.sub(repl, s)
+
+
+sp_head_re = re.compile('{#SHS#}(.*?){#SHE#}')
+bbtag_re = re.compile(r'\[[^\]]+\]')
+
+
+def ascii_compatible(charset):
+    """Tell if ASCII text looks the same in charset, so HTML can be
+    searched for tags and patterns without decoding."""
+    try:
+        return codecs.lookup(charset).encode(ASCII_SAMPLE)[0] == str(ASCII_SAMPLE)
+    except LookupError:
+        return True  # decoding will fall back to cp1251 anyway
+
+
+def contains_nocase(data, key, chunk=2 ** 20):
+    """Tell if data (string or mmap) contains lowercase key in any case."""
+    step = chunk - len(key) + 1
+    for i in xrange(0, len(data), step):
+        if data[i:i + chunk].lower().find(key) >= 0:
+            return True
+    return False
+
+
+def walk_tags(s, handler):
+    """Replace every HTML element with handler(tag, attr, content).
+    
+    The string is tokenized once and elements are reduced bottom-up on
+    a stack, so the content passed to handler is already converted.
+    Unclosed elements are left as-is, the same way the old fixed-point
+    regexp loop left them. A stray '<' may form a new tag with what
+    follows once that is replaced, so strings that have one go through
+    that loop instead, see reduce_tags(). Return a tuple (string,
+    replaced tags).
+    """
+    out = []
+    stack = []  # open elements: (tag, attr, raw tag, content parts)
+    parts = out
+    n = 0
+    pos = 0
+    for m in token_re.finditer(s):
+        if m.start() > pos:
+            parts.append(s[pos:m.start()])
+        pos = m.end()
+        tok = m.group()
+        tag = m.group('tag')
+        if tag is not None:
+            attr = m.group('attr')
+            if attr[-1:] == '/':
+                # self-closed tag
+                parts.append(handler(tag, attr[:-1], ''))
+                n += 1
+            else:
+                parts = []
+                stack.append((tag, attr, tok, parts))
+        elif tok == '<':
+            return reduce_tags(s, handler)
+        elif not stack:
+            parts.append(tok)
+        else:
+            # Any closing tag closes the innermost open element.
+            e = stack.pop()
+            parts = stack[-1][3] if stack else out
+            parts.append(handler(e[0], e[1], ''.join(e[3])))
+            n += 1
+    parts.append(s[pos:])
+    while stack:
+        e = stack.pop()
+        parts = stack[-1][3] if stack else out
+        parts.append(e[2])
+        parts.extend(e[3])
+    return ''.join(out), n
+
+
+def reduce_tags(s, handler):
+    """Replace HTML elements as walk_tags() does, by the old way of
+    replacing self-closed tags, then innermost paired ones until none
+    is left."""
+    def sub(m):
+        return handler(m.group('tag'), m.group('attr'), m.group('content'))
+    s, n = self_closed_re.subn(sub, s)
+    more = 1
+    while more > 0:
+        s, more = paired_re.subn(sub, s)
+        n += more
+    return s, n
+
+
+def rehost_urls(urls, referers, log=print):
+    """Rehost images from urls (hash -> URL), replacing URLs in place.
+    
+    referers maps hashes to referer URLs, log is used to report progress.
+    """
+    if len(urls) == 0:
+        return
+    def print_urls(a, b):
+        if a != b:
+            log('{0} >> {1}'.format(a, b))
+    log('Processing {0} URLs...'.format(len(urls)))
+    dedup = dict(rehost_m.dedup_stats)
+    cached = rehost_m.cache_stats()
+    # Rehost images.
+    if gevent:
+        pool = Pool(POOL_SIZE)
+        def fin(h, url):
+            def f(g):
+                urls[h] = g.value
+                print_urls(url, g.value)
+            return f
+        for h, url in urls.items():
+            j = pool.spawn(rehost, url, image=True,
+                           referer=referers[h])
+            j.link_value(fin(h, url))
+        pool.join()
+    else:
+        for h, url in urls.items():
+            new_url = rehost(url, image=True,
+                             referer=referers[h])
+            urls[h] = new_url
+            print_urls(url, new_url)
+    rehost_m.cache_flush()
+    files = rehost_m.dedup_stats['files'] - dedup['files']
+    if files:
+        log('-- {0} images were already uploaded from other URLs, '
+            '{1} KB of upload saved'.format(
+            files, (rehost_m.dedup_stats['bytes'] - dedup['bytes']) // 1024))
+    st = rehost_m.cache_stats()
+    st = dict((k, st[k] - cached[k]) for k in st)
+    if any(st.values()):
+        log('-- ' + rehost_m.CACHE_STATS_FMT.format(**st))
+
+
+class TargetError(Exception):
+    """Target can't be opened or parsed."""
+
+
+class Converter(object):
+    """Conversion of a page to BBCode.
+    
+    Holds the state of a single conversion: the target, used to resolve
+    relative URLs and to pick the site rules, the options and the URLs
+    found so far. Compiled rules are shared between all converters for
+    the same site, so converters are cheap and independent of each other.
+    """
+    def __init__(self, target='', count=1, charset='', no_rehost=False,
+                 no_thumb=False, verbose=True):
+        self.target = target
+        if target and not os.path.isfile(target):
+            tp = urlparse(target)
+            self.site_root = urlunparse([tp.scheme, tp.netloc] + [''] * 4)
+            self.target_root = self.site_root + re.sub('[^/]*$', '', tp.path)
+        else:
+            self.site_root = ''
+            self.target_root = ''
+        self.rules = rules_m.for_host(self.site_root)
+        self.count = count
+        self.charset = charset
+        self.no_rehost = no_rehost
+        self.no_thumb = no_thumb
+        self.verbose = verbose
+        self.charsets = [charset or 'cp1251']
+        self.urls = {}
+        self.mapping = {}  # original URL -> rehosted one, for all posts
     
-    for (i,v) in COMPLEX_RULES:
-        dm = re.search(FLAGS + i, d['attr'])
+    def log(self, *args, **kwargs):
+        """Print progress, unless told to be quiet."""
+        if self.verbose:
+            print(*args, **kwargs)
+    
+    def run(self, html=None):
+        """Convert the target, or html if given, and return BBCode."""
+        if html is None:
+            html = self.read()
+        elif not isinstance(html, unicode):
+            self.charsets = self.detect_charsets(html)
+        posts = self.extract_posts(html)
+        return self.postprocess('\n\n'.join([self.process(p) for p in posts]))
+    
+    def read(self):
+        """Open the target and return its contents, not decoded.
+        
+        Local files and downloaded pages are memory-mapped, so posts are
+        extracted without reading the whole page into memory; only the
+        posts get decoded later. Pages in charsets that are not a superset
+        of ASCII are decoded right away.
+        """
+        target = self.target
+        self.log('Opening target...', end=' ')
+        fd, ftype, finfo = open_thing(target)
+        if fd is None:
+            raise TargetError('target unreachable.')
+        if finfo is not None:
+            if finfo.maintype != 'text':
+                raise TargetError('cannot parse "{0}".'.format(finfo.maintype))
+            if finfo.url != target and 'login' in finfo.url:
+                raise TargetError('redirected to login page.\n' +
+                    'Try to save the page from your browser and pass the file.')
+        self.log('ok')
+        try:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            data = fd.read()  # empty file
+        fd.close()
+        if len(data) == 0:
+            raise TargetError('nothing to parse.')
+        self.charsets = self.detect_charsets(data, finfo)
+        if not ascii_compatible(self.charsets[0]):
+            data = self.decode(data)
+        return data
+    
+    def detect_charsets(self, data, finfo=None):
+        """Return the charsets to try on the page, most likely first.
+        
+        The charset is taken from the options, the HTTP header, the BOM,
+        the <meta> tag or guessed by chardet, in that order. Only the
+        beginning of the page is looked at, or for chardet, the beginning
+        of its non-ASCII text.
+        """
+        charset = self.charset
+        if not charset and finfo is not None:
+            charset = finfo.getparam('charset')
+        sample = data[:CHARSET_SAMPLE]
+        if not charset:
+            for bom, c in BOMS:
+                if sample.startswith(bom):
+                    charset = c
+                    break
+        if not charset:
+            m = meta_charset_re.search(sample)
+            if m is not None:
+                charset = m.group(1)
+        if not charset and chardet is not None:
+            charset = chardet.detect(sample)['encoding']
+            if charset == 'ascii':
+                m = non_ascii_re.search(data, len(sample))
+                if m is not None:
+                    charset = chardet.detect(
+                        data[m.start():m.start() + CHARSET_SAMPLE])['encoding']
+            if charset == 'ascii':
+                # still undecided; UTF-8 rarely decodes other charsets
+                charset = 'utf-8'
+        if not charset:
+            charset = 'cp1251'
+        self.log('Page charset: {0}'.format(charset))
+        return [charset] + [x for x in ['cp1251', 'utf-8'] if x != charset]
+    
+    def decode(self, s):
+        """Decode a piece of the page."""
+        if isinstance(s, unicode):
+            return s
+        if not isinstance(s, str):
+            s = s[:]  # mmap
+        for c in self.charsets:
+            try:
+                return s.decode(c)
+            except (LookupError, UnicodeError):
+                self.log('decoding as {0}... failed'.format(c))
+        raise TargetError('nothing to parse.')
+    
+    def iter_posts(self, page):
+        """Yield posts found in the page, or the whole page if none.
+        
+        The page may be unicode, or bytes or mmap in an ASCII-compatible
+        charset; the posts are yielded the same type, not decoded. The
+        first pattern that matches is used. Patterns whose literal text
+        is missing from the page are skipped without a scan, and the page
+        is scanned only as far as the posts are consumed.
+        """
+        for p, keys in zip(self.rules.posts, self.rules.post_keys):
+            missing = [k for k in keys if page.find(k) < 0]
+            # Patterns ignore case, and lowering the page takes a while.
+            if not all(contains_nocase(page, k) for k in missing):
+                continue
+            found = False
+            for m in p.finditer(page):
+                found = True
+                yield m.group(1)
+            if found:
+                return
+        self.log('\n[!] Warning: no pattern for this page detected - parsing whole page!' +
+            '\n[!] You may want to ask the author for new pattern' +
+            ' to reduce amount of shit in the output.\n')
+        yield page
+    
+    def extract_posts(self, page):
+        """Return a list of at most count posts found in the page, decoded."""
+        return [self.decode(p) for p in islice(self.iter_posts(page), self.count)]
+    
+    def proctag(self, tag, attr, dc):
+        """Return a replacement for single HTML tag."""
+        rules = self.rules
+        tag = tag.lower()
+        if rules.skip_attr_re.search(attr):
+            return ''
+        if rules.flatten_re is not None and rules.flatten_re.search(attr):
+            dc = dc.replace('\n', ' ')
+        if tag in rules.tags:
+            optag, cltag = rules.tags[tag]
+            return optag + dc + cltag
+        
+        v, dm = rules.complex.match(attr)
         if dm is None:
-            continue
+            # unknown tags
+            return dc
         optag = v[0]
         cltag = v[1]
         try:
             g = dm.groups('')[0]
         except IndexError:
             g = ''
-        # Fix hdclub fucked-up colors.
-        if 'hdclub' in site_root and cltag == '[/color]':
-            if g == '#999966': g = '#005000'
-            if g == '#006699': g = '#000000'
+        # Fix site-specific colors.
+        if cltag == '[/color]' and g in rules.colors:
+            g = rules.colors[g]
         # <div style="float:right"><img/></div> => [img=right]
         if optag == '{#FLOAT#}':
-            dc = re.sub(r'\[img\]', '[img=' + g + ']', dc)
+            dc = dc.replace('[img]', '[img=' + g + ']')
             optag = ''
         # ban comic sans
         if cltag == '[/font]' and g == "'Comic Sans MS'":
@@ -218,166 +455,434 @@ def proctag(m):
         optag = optag.replace('_', g)
         if v[0] == '[img=_]': g = dm.groups('')[1]
         
-        if d['tag'] in TAGS_WITH_URLS and g != '':
+        if tag in TAGS_WITH_URLS and g != '':
             if urlparse(g).scheme == '':
                 if g[0] == '/':
-                    g = site_root + g
+                    g = self.site_root + g
                 else:
-                    g = target_root + g
+                    g = self.target_root + g
             if urlparse(g).scheme == 'http':
                 g = decode_html_entities(g)
                 g_ = hashurl(g)
                 # Save url and it's replacement for future.
-                urls[g_], g = g, g_
-                if d['tag'] == 'a':
+                self.urls[g_], g = g, g_
+                if tag == 'a':
                     optag = v[0].replace('_', g)
-                if d['tag'] in ('var', 'img'):
+                if tag in ('var', 'img'):
                     dc = g
             else:
                 # Omit tags with weird URLs.
                 return dc
         # Spoilers
         if optag == '{#SP#}':
-            hs = re.search('{#SHS#}(.*?){#SHE#}', dc)
+            hs = sp_head_re.search(dc)
             if hs:
-                optag = '[spoiler="' + re.sub(r'\[[^\]]+\]', '', hs.group(1)) + '"]'
+                optag = '[spoiler="' + bbtag_re.sub('', hs.group(1)) + '"]'
                 dc = dc.replace(hs.group(0),'')
             else:
                 optag = '[spoiler]'
         # [pre] emulation (via &npsp;)
-        if d['tag'] == 'pre':
+        if tag == 'pre':
             dc = dc.replace(' ', '&#160;')
-        
-        if v[0] in BBTAGS_NO_NEST:
-            return reduce_nest(dc, optag, cltag, v[0], v[1])
         return optag + dc + cltag
-    # unknown tags
-    return dc
-
-
-def process(s):
-    global urls
-    urls = {}
-    # Hackity hack.
-    s = s.split('class="attach')[0].split('<')
-    s.pop()
-    s = '<'.join(s)
-    # Cut out bad tags.
-    for t in SKIP_TAGS:
-        s = re.sub(FLAGS + '\s*<(?P<tag>' + t + ').*?</(?P=tag)>\s*', '', s)
-    # Apply simple rules.
-    for (k, r) in SIMPLE_RULES:
-        s = re.sub(FLAGS + k, r, s)
-    # Close tags that should be closed, leave already closed as-is
-    for t in CLOSED_TAGS:
-        s = re.sub(FLAGS + r'<({0}[^>]*?)/?>'.format(t), r'<\1/>', s)
+    
+    def convert(self, s):
+        """Convert HTML to BBCode, leaving hashes in place of URLs.
+        
+        Return a tuple (bbcode, urls), where urls maps hashes to URLs.
+        """
+        rules = self.rules
+        self.urls = {}
+        # Hackity hack.
+        s = s.split('class="attach')[0].split('<')
+        s.pop()
+        s = '<'.join(s)
+        # Cut out bad tags.
+        for r in rules.skip_tags:
+            s = r.sub('', s)
+        # Apply simple rules.
+        for r, repl in rules.simple:
+            s = r.sub(repl, s)
+        # Close tags that should be closed, leave already closed as-is
+        s = rules.closed_re.sub(r'<\1/>', s)
         # Maybe this is overkill, but why not.
-        s = s.replace('</{0}>'.format(t), '')
-    # Apply complex rules.
-    (s, n) = ntag_re.subn(proctag, s)
-    m, n = n, 1
-    while n > 0:
-        (s, n) = ptag_re.subn(proctag, s)
-        m += n
-    # Strip out any HTML leftovers.
-    s = re.sub('<[^>]+>','',s)
-    if m > 0:
-        print('Replaced {0} tags'.format(m))
-    
-    if not args.no_rehost and len(urls) > 0:
-        def print_urls(a, b):
-            if a != b:
-                print('{0} >> {1}'.format(a, b))
-        print('Processing {0} URLs...'.format(len(urls)))
-        # Rehost images.
-        if gevent:
-            pool = Pool(POOL_SIZE)
-            def fin(h, url):
-                def f(g):
-                    urls[h] = g.value
-                    print_urls(url, g.value)
-                return f
-            for h, url in urls.iteritems():
-                j = pool.spawn(rehost, url, image=True, referer=target_root)
-                j.link_value(fin(h, url))
-            pool.join()
+        s = rules.unclosed_re.sub('', s)
+        # Apply complex rules.
+        s, m = walk_tags(s, self.proctag)
+        # Strip out any HTML leftovers.
+        s = re.sub('<[^>]+>','',s)
+        s = bbcode.normalize(s)
+        if m > 0:
+            self.log('Replaced {0} tags'.format(m))
+        return s, self.urls
+    
+    def restore_urls(self, s, urls, orig=None):
+        """Bring URLs back in places of their hashes, finish the BBCode.
+        
+        urls maps hashes to the final URLs; orig, if given, maps them to
+        the URLs found in the post, to tell how many were rehosted.
+        """
+        if orig is None:
+            imgs = len([p for (p, url) in urls.iteritems() if hashurl(url) != p])
         else:
-            for h, url in urls.iteritems():
-                new_url = rehost(url, image=True, referer=target_root)
-                urls[h] = new_url
-                print_urls(url, new_url)
-    # Bring URLs back in places.
-    imgs = 0
-    for p, url in urls.iteritems():
-        if hashurl(url) != p:
-            imgs += 1
-        s = s.replace(p, urls[p])
-    if imgs > 0:
-        print('Found and replaced {0} images'.format(imgs))
-    return decode_html_entities(s).strip()
-
-
-def postprocess(s):
-    """Prettify the bbcode."""
-    print('Post-processing...')
-    
-    # Poster fix: make the poster float to the right
-    if any([x in site_root for x in ('epidemz', 'hdclub')]) or s[:5] == '[img]':
-        s = re.sub(r'\[img[^]]*\]', r'[img=right]', s, 1)
-        print('-- poster fix applied')
-    
-    # List fix: convert list of "[*]" to proper bulleted list
-    if '[list]' not in s and '[*]' in s:
-        s, n = re.subn(r'(\[\*\].*)', r'[list]\1[/list]', s)
-        if n > 0:
-            s = re.sub(r'\[/list\]\s*\[list\]', '', s)
-            print('-- list fix applied ({0} items)'.format(n))
-    
-    # Thumbnail fix: generate thumbnails for linked images
-    if not args.no_thumb and Image:
-        def thumb(m):
-            d = m.groupdict()
-            url = d['url']
-            old_th = d['th']
-            code_origin = m.group()
-            code_normal = '[url={0}][img]{1}[/img][/url]'
-            tname = 't' + hashurl(url) + '.jpg'
-            th = rehost_m.cache_search(tname)
-            if th is not None:
-                print('.  {0} - from cache'.format(th))
+            imgs = len([p for (p, url) in urls.iteritems() if orig[p] != url])
+        if urls:
+            s = replace_hashes(s, urls)
+        if imgs > 0:
+            self.log('Found and replaced {0} images'.format(imgs))
+        return decode_html_entities(s).strip()
+    
+    def process(self, s):
+        """Convert HTML to BBCode, rehosting images unless told otherwise."""
+        s, found = self.convert(s)
+        orig = dict(found)
+        if not self.no_rehost:
+            rehost_urls(found, dict.fromkeys(found, self.target_root), self.log)
+        for h, url in found.iteritems():
+            self.mapping[orig[h]] = url
+        return self.restore_urls(s, found, orig)
+    
+    def postprocess(self, s):
+        """Prettify the bbcode."""
+        self.log('Post-processing...')
+        
+        # Poster and list fixes, block tags on their own lines.
+        f = bbcode.Formatter(poster=self.rules.poster_fix)
+        s = f.format(s)
+        if f.poster_fixed:
+            self.log('-- poster fix applied')
+        if f.list_lines > 0:
+            self.log('-- list fix applied ({0} items)'.format(f.list_lines))
+        
+        # Thumbnail fix: generate thumbnails for linked images
+        if not self.no_thumb and Image:
+            def thumb(m):
+                d = m.groupdict()
+                url = d['url']
+                old_th = d['th']
+                code_origin = m.group()
+                code_normal = '[url={0}][img]{1}[/img][/url]'
+                tname = 't' + hashurl(url) + '.jpg'
+                th = rehost_m.cache_search(tname)
+                if th is not None:
+                    self.log('.  {0} - from cache'.format(th))
+                    return code_normal.format(url, th)
+                try:
+                    i = Image.open(open_thing(url)[0])
+                    if old_th != url:
+                        t = Image.open(open_thing(old_th)[0])
+                        f1 = float(i.size[1]) / i.size[0]
+                        f2 = float(t.size[1]) / t.size[0]
+                        if abs(f1 - f2) / (f1 + f2) < 0.02 and t.size[0] >= 180:
+                            self.log('.  {0} - good'.format(old_th))
+                            rehost_m.cache_write(tname, old_th)
+                            return code_origin
+                    i.thumbnail(THUMB_SIZE, Image.ANTIALIAS)
+                    i.save(tname, quality=85)
+                except IOError as ex:
+                    self.log(ex)
+                    return code_origin
+                th = rehost(tname, force_cache=True)
+                try:
+                    os.unlink(tname)
+                except:
+                    pass
+                self.log('.  {0} - new'.format(th))
                 return code_normal.format(url, th)
-            try:
-                i = Image.open(open_thing(url)[0])
-                if old_th != url:
-                    t = Image.open(open_thing(old_th)[0])
-                    f1 = float(i.size[1]) / i.size[0]
-                    f2 = float(t.size[1]) / t.size[0]
-                    if abs(f1 - f2) / (f1 + f2) < 0.02 and t.size[0] >= 180:
-                        print('.  {0} - good'.format(old_th))
-                        rehost_m.cache_write(tname, old_th)
-                        return code_origin
-                i.thumbnail(THUMB_SIZE, Image.ANTIALIAS)
-                i.save(tname, quality=85)
-            except IOError as ex:
-                print(ex)
-                return code_origin
-            th = rehost(tname, force_cache=True)
-            try:
-                os.unlink(tname)
-            except:
-                pass
-            print('.  {0} - new'.format(th))
-            return code_normal.format(url, th)
-        s, n = thumb_re.subn(thumb, s)
-        if n > 0:
-            print('-- thumbnail fix ({0} checked)'.format(n))
-    
-    surround = ('/?quote(="[^"]*")?', '/?spoiler(="[^"]*")?', '/?list', 'hr')
-    for t in surround:
-        s = re.sub(r'\s*(\[' + t + r'\])\s*', r'\n\1\n', s)
-    s = '\n'.join([x.strip() for x in s.splitlines()])
-    print('Post-processing done')
-    return s
+            s, n = thumb_re.subn(thumb, s)
+            if n > 0:
+                self.log('-- thumbnail fix ({0} checked)'.format(n))
+            rehost_m.cache_flush()
+        self.log('Post-processing done')
+        return s
+
+
+def batch_targets(targets, listfile=None):
+    """Expand directories and the list file into a list of targets."""
+    res = []
+    for t in targets:
+        if os.path.isdir(t):
+            res += sorted([os.path.join(t, f) for f in os.listdir(t)
+                           if f.lower().endswith(('.htm', '.html'))])
+        else:
+            res.append(t)
+    if listfile is not None:
+        for l in listfile:
+            l = l.strip()
+            if l and not l.startswith('#'):
+                res.append(l)
+    return res
+
+
+def batch_outname(target, outdir, taken):
+    """Return a free output file name for the target."""
+    if os.path.isfile(target):
+        name = os.path.splitext(os.path.basename(target))[0]
+    else:
+        tp = urlparse(target)
+        name = re.sub(r'[^\w.-]+', '_', tp.netloc + tp.path + '_' + tp.query)
+        name = name.strip('_.')
+    fname, n = name, 1
+    while fname in taken:
+        n += 1
+        fname = '{0}_{1}'.format(name, n)
+    taken.add(fname)
+    return os.path.join(outdir, fname + '.txt')
+
+
+def _batch_init(opts):
+    """Pool worker initializer."""
+    global batch_opts
+    batch_opts = opts
+
+
+@contextmanager
+def _batch_log(log):
+    """Send what a pool worker prints to log.
+    
+    The log goes back to the parent, which prints it in one piece (see
+    batch_report()), so the output of targets doesn't interleave.
+    """
+    stdout, sys.stdout = sys.stdout, log
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+def _batch_convert(target):
+    """Pool worker: read the target and convert its posts."""
+    log = StringIO()
+    with _batch_log(log):
+        try:
+            c = Converter(target, **batch_opts)
+            posts = c.extract_posts(c.read())
+            outs = [c.convert(p) for p in posts]
+            return target, outs, c.target_root, None, log.getvalue()
+        except TargetError as ex:
+            return target, None, None, str(ex), log.getvalue()
+
+
+def _batch_finish(job):
+    """Pool worker: restore URLs, postprocess and write the output."""
+    target, outs, outname = job
+    log = StringIO()
+    with _batch_log(log):
+        try:
+            c = Converter(target, **batch_opts)
+            outstr = '\n\n'.join([c.restore_urls(s, u, o) for (s, u, o) in outs])
+            outstr = c.postprocess(outstr)
+            with open(outname, 'wb') as f:
+                f.write(outstr.encode('utf-8'))
+        except IOError as ex:
+            print('[!] I/O error.', ex)
+            return target, None, log.getvalue()
+        print('Output written to', outname)
+        return target, outname, log.getvalue()
+
+
+def batch_report(target, log):
+    """Print a worker's log, every line prefixed with its target."""
+    for line in log.splitlines():
+        if line.strip():
+            print('{0}: {1}'.format(target, line))
+
+
+def batch(targets, outdir, jobs=None, **opts):
+    """Convert many targets, one output file per target.
+    
+    Converting and post-processing run in a pool of processes; images
+    of all targets are rehosted at once by this process, so a picture
+    used on several pages is rehosted only once. opts are passed
+    to Converter.
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    pool = multiprocessing.Pool(jobs, _batch_init, (opts,))
+    try:
+        # map_async() keeps KeyboardInterrupt working
+        done = pool.map_async(_batch_convert, targets).get(sys.maxint)
+        found, referers = {}, {}
+        for (target, outs, root, err, log) in done:
+            batch_report(target, log)
+            if err is not None:
+                print('[!] {0}: {1}'.format(target, err))
+                continue
+            for (s, u) in outs:
+                for h in u:
+                    referers.setdefault(h, root)
+                found.update(u)
+        if not opts.get('no_rehost'):
+            rehost_urls(found, referers)
+        jobs, taken = [], set()
+        for (target, outs, root, err, log) in done:
+            if err is None:
+                outs = [(s, dict([(h, found[h]) for h in u]), u) for (s, u) in outs]
+                jobs.append((target, outs, batch_outname(target, outdir, taken)))
+        finished = pool.map_async(_batch_finish, jobs).get(sys.maxint)
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    written = []
+    for (target, outname, log) in finished:
+        batch_report(target, log)
+        if outname is not None:
+            written.append(outname)
+    print('Converted {0} of {1} targets'.format(len(written), len(targets)))
+    return written
+
+
+class ConvertHandler(BaseHTTPRequestHandler):
+    """Conversion API: POST /convert with a JSON object.
+    
+    The object must have either "html" (page or post source) or "target"
+    (URL to fetch); with "html", "target" is still used to resolve relative
+    URLs and to pick the site rules. "count", "charset", "no_rehost" and
+    "no_thumb" override the server defaults. The reply is a JSON object
+    with "bbcode" and "urls" (original URL -> rehosted one), or "error".
+    """
+    server_version = 'getbb/0.10'
+    
+    def reply(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_GET(self):
+        if self.path != '/':
+            return self.reply(404, {'error': 'not found'})
+        self.reply(200, {'version': self.server_version})
+    
+    def do_POST(self):
+        if self.path != '/convert':
+            return self.reply(404, {'error': 'not found'})
+        try:
+            size = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            return self.reply(411, {'error': 'Content-Length required'})
+        if size > MAX_REQUEST:
+            return self.reply(413, {'error': 'request too big'})
+        try:
+            req = json.loads(self.rfile.read(size))
+            if not isinstance(req, dict):
+                raise ValueError('JSON object expected')
+            html = req.get('html')
+            target = req.get('target') or ''
+            if html is not None and not isinstance(html, basestring):
+                raise ValueError('"html" must be a string')
+            if not isinstance(target, basestring):
+                raise ValueError('"target" must be a string')
+            if html is None and not target:
+                raise ValueError('either "html" or "target" required')
+            # no local files here
+            if target and urlparse(target).scheme not in ('http', 'https'):
+                raise ValueError('"target" must be an http(s) URL')
+            opts = dict(self.server.opts)
+            for k in opts:
+                v = req.get(k)
+                if v is None:
+                    continue
+                t = type(opts[k])
+                if t is bool:
+                    ok = isinstance(v, bool)
+                elif t is int:
+                    ok = isinstance(v, (int, long)) and \
+                        not isinstance(v, bool) and 0 < v <= sys.maxsize
+                else:
+                    ok = isinstance(v, basestring) and \
+                        all(ord(ch) < 128 for ch in v)
+                if not ok:
+                    raise ValueError('"{0}" must be {1}'.format(
+                        k, {bool: 'true or false',
+                            int: 'a positive integer'}.get(
+                            t, 'an ASCII string')))
+                opts[k] = t(v)
+        except (TypeError, ValueError) as ex:
+            return self.reply(400, {'error': str(ex)})
+        try:
+            c = Converter(target, verbose=False, **opts)
+        except (EnvironmentError, SyntaxError, ValueError) as ex:
+            return self.reply(500, {'error': 'bad rules file: {0}'.format(ex)})
+        try:
+            s = c.run(html)
+        except TargetError as ex:
+            return self.reply(502, {'error': str(ex)})
+        except Exception as ex:
+            self.log_error('conversion failed: %r', ex)
+            return self.reply(500, {'error': 'conversion failed: {0!r}'.format(
+                ex)})
+        self.reply(200, {'bbcode': s, 'urls': c.mapping})
+    
+    def log_message(self, format, *args):
+        # Unix socket clients have no address.
+        host = self.client_address[0] if self.client_address else 'unix'
+        print('{0} - [{1}] {2}'.format(
+            host, self.log_date_time_string(), format % args))
+
+
+class _Serving(ThreadingMixIn):
+    """Handle every request in a thread, or a greenlet if we have gevent."""
+    daemon_threads = True
+    
+    def process_request(self, request, client_address):
+        if gevent:
+            gevent.spawn(self.process_request_thread, request, client_address)
+        else:
+            ThreadingMixIn.process_request(self, request, client_address)
+
+
+class TCPServer(_Serving, HTTPServer):
+    pass
+
+
+class UnixServer(_Serving, UnixStreamServer):
+    pass
+
+
+def serve(address, **opts):
+    """Serve the conversion API until interrupted.
+    
+    address is a Unix socket path (anything with a '/') or [host:]port.
+    opts are the defaults for Converter. Rules and the link cache are
+    loaded once here and stay warm between requests.
+    """
+    rules_m.for_host('')
+    rehost_m.cache_search('')
+    if gevent:
+        # serve_forever() waits in select()
+        from gevent import monkey; monkey.patch_select()
+    if '/' in address:
+        if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            os.unlink(address)
+        server = UnixServer(address, ConvertHandler)
+    else:
+        host, _, port = address.rpartition(':')
+        server = TCPServer((host or '127.0.0.1', int(port)), ConvertHandler)
+    server.opts = opts
+    print('Serving on', address)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if '/' in address:
+            os.unlink(address)
+
+
+def positive_int(s):
+    """argparse type: an integer above zero."""
+    try:
+        n = int(s)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError(
+            'expected a positive integer, got {0!r}'.format(s))
+    return n
 
 
 if __name__ == '__main__':
@@ -386,16 +891,35 @@ if __name__ == '__main__':
         epilog='Latest version and more info at https://github.com/atomizer/getbb'
     )
     p.add_argument(
-        'target', help='local file or URL to be parsed'
+        'targets', metavar='target', nargs='*',
+        help='local file or URL to be parsed; several targets or '
+             'a directory of saved pages turn on batch mode'
     )
     p.add_argument(
         '-o', dest='output',
         default=os.path.join(os.path.abspath(os.path.dirname(__file__)), 'out.txt'),
-        type=argparse.FileType('w'),
         help='write output to file (default: %(default)s)'
     )
     p.add_argument(
-        '-c', metavar='N', dest='count', type=int, default=1,
+        '-l', dest='listfile', type=argparse.FileType('r'),
+        help='batch mode: read targets from file, one per line'
+    )
+    p.add_argument(
+        '-d', dest='outdir',
+        default=os.path.join(os.path.abspath(os.path.dirname(__file__)), 'out'),
+        help='batch mode: write outputs to directory (default: %(default)s)'
+    )
+    p.add_argument(
+        '-j', metavar='N', dest='jobs', type=int, default=None,
+        help='batch mode: use N processes (default: number of CPUs)'
+    )
+    p.add_argument(
+        '--serve', metavar='ADDR',
+        help='run as a server at ADDR ([host:]port or Unix socket path), '
+             'options below become the defaults'
+    )
+    p.add_argument(
+        '-c', metavar='N', dest='count', type=positive_int, default=1,
         help='parse N consecutive posts (default: 1)'
     )
     p.add_argument(
@@ -417,78 +941,63 @@ if __name__ == '__main__':
     args = p.parse_args()
     
     
-    if not os.path.isfile(args.target):
-        tp = urlparse(args.target)
-        site_root = urlunparse([tp.scheme, tp.netloc] + [''] * 4)
-        target_root = site_root + re.sub('[^/]*$', '', tp.path)
-    else:
-        site_root = ''
-        target_root = ''
-    
-    
-    print('Opening target...', end=' ')
-    fd, ftype, finfo = open_thing(args.target)
-    if fd is None:
-        sys.exit('Terminated: target unreachable.')
-    if finfo is not None:
-        if finfo.maintype != 'text':
-            sys.exit('Terminated: cannot parse "{0}".'.format(finfo.maintype))
-        if finfo.url != args.target and 'login' in finfo.url:
-            sys.exit('Terminated: redirected to login page.\n' +
-                'Try to save the page from your browser and pass the file.')
-    print('ok')
-    inbytes = fd.read()
-    # Detect charset and decode input.
-    target_charset = args.charset
-    instr = ''
-    if not target_charset and finfo is not None:
-        target_charset = finfo.getparam('charset')
-    if not target_charset:
-        if chardet is not None:
-            target_charset = chardet.detect(inbytes)['encoding']
-        else:
-            target_charset = 'cp1251'
-    for c in [target_charset] + [x for x in ['cp1251', 'utf-8'] if x != target_charset]:
-        print('decoding as {0}...'.format(c), end=' ')
+    opts = dict(count=args.count, charset=args.charset,
+                no_rehost=args.no_rehost, no_thumb=args.no_thumb)
+    if args.serve:
         try:
-            instr = inbytes.decode(c)
-            print('ok')
-            break
-        except:
-            print('failed')
-    if not instr:
-        sys.exit('Terminated: nothing to parse.')
-    # Extract posts.
-    for p in PSTO_PATTERNS:
-        m = re.findall(FLAGS + p, instr)
-        if len(m) > 0:
-            m = m[:args.count]
-            break
-    if len(m) == 0:
-        print('\n[!] Warning: no pattern for this page detected - parsing whole page!' +
-            '\n[!] You may want to ask the author for new pattern' +
-            ' to reduce amount of shit in the output.\n')
-        m = [instr]
+            serve(args.serve, **opts)
+        except (EnvironmentError, SyntaxError, ValueError) as ex:
+            sys.exit('Terminated: {0}'.format(ex))
+        except KeyboardInterrupt:
+            sys.exit('\nTerminated manually.')
+        sys.exit()
+    
+    if not args.targets and args.listfile is None:
+        p.error('no target given')
+    
+    if (len(args.targets) > 1 or args.listfile is not None or
+            os.path.isdir(args.targets[0])):
+        targets = batch_targets(args.targets, args.listfile)
+        try:
+            rules_m.load()
+        except (EnvironmentError, SyntaxError, ValueError) as ex:
+            sys.exit('Terminated: bad rules file: {0}'.format(ex))
+        try:
+            batch(targets, args.outdir, args.jobs, **opts)
+        except KeyboardInterrupt:
+            sys.exit('\nTerminated manually.')
+        sys.exit()
+    
+    try:
+        conv = Converter(args.targets[0], **opts)
+    except (EnvironmentError, SyntaxError, ValueError) as ex:
+        sys.exit('Terminated: bad rules file: {0}'.format(ex))
+    try:
+        m = conv.extract_posts(conv.read())
+    except TargetError as ex:
+        sys.exit('Terminated: {0}'.format(ex))
     outs = []
     try:
         for i, p in enumerate(m):
             if len(m) > 1:
                 print('Post {0}/{1}'.format(i+1, len(m)))
-            outs += [process(p)]
+            outs += [conv.process(p)]
     except KeyboardInterrupt as ex:
         sys.exit('\nTerminated manually.')
     outstr = '\n\n'.join(outs)
     try:
-        outstr = postprocess(outstr)
+        outstr = conv.postprocess(outstr)
     except KeyboardInterrupt as ex:
         print('\nPost-processing terminated.')
     
     try:
-        args.output.write(outstr.encode('utf-8'))
-        print('Output written to', args.output.name)
+        # opened only now, batch and server runs don't touch it
+        with open(args.output, 'w') as f:
+            f.write(outstr.encode('utf-8'))
+        print('Output written to', args.output)
     except IOError as ex:
         print('[!] I/O error.', ex)
         sys.exit(1)
     
-    if not args.no_open and os.path.isfile(args.output.name) and os.name == 'nt':
-        os.startfile(args.output.name, 'open')
+    if not args.no_open and os.path.isfile(args.output) and os.name == 'nt':
+        os.startfile(args.output, 'open')
@@ -0,0 +1,390 @@
+# 2010 atomizer
+"""Persistent link cache: source URL -> download URL.
+
+Links live in an sqlite database, looked up by its primary key index.
+The links used recently are also kept in memory, and new links are
+written in batches. The old tab-separated linkcache.txt is imported
+once, when the database is created.
+
+Several processes may share the cache: sqlite locks the file for
+writes, and a source being uploaded is marked "in flight", so the
+others wait for its link instead of uploading it once more.
+
+Uploaded content is also indexed by its digest, so the same file
+linked from several places is uploaded only once.
+
+Run as a script to see statistics, drop old or dead links and compact
+the database (see --help).
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import time
+import errno
+import atexit
+import sqlite3
+import urllib2
+import threading
+from collections import OrderedDict
+
+try:
+    from gevent import sleep
+except ImportError:
+    from time import sleep
+
+__all__ = ['LinkCache', 'link_alive', 'read_legacy', 'CACHE_FILE', 'LEGACY_FILE']
+
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linkcache.db')
+LEGACY_FILE = os.path.join(os.path.dirname(CACHE_FILE), 'linkcache.txt')
+
+SCHEMA = 'CREATE TABLE links (src TEXT PRIMARY KEY, dl TEXT NOT NULL, added REAL)'
+INDEX_SCHEMA = 'CREATE INDEX IF NOT EXISTS links_added ON links (added)'
+INFLIGHT_SCHEMA = ('CREATE TABLE IF NOT EXISTS inflight '
+                   '(src TEXT PRIMARY KEY, pid INTEGER, started REAL)')
+DIGESTS_SCHEMA = ('CREATE TABLE IF NOT EXISTS digests '
+                  '(digest TEXT PRIMARY KEY, dl TEXT NOT NULL, size INTEGER, '
+                  'added REAL)')
+STALE = 600  # seconds after which an in-flight mark is ignored
+POLL = 0.5  # seconds between checks while waiting for another upload
+STATS = ('hits', 'db_hits', 'misses', 'expired')
+
+
+def _key(s):
+    """URLs are stored as UTF-8 bytes, whatever they came as."""
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+def _alive(pid):
+    """Tell if a process is running (always True where we can't know)."""
+    if os.name != 'posix':
+        return True  # os.kill() would kill it on Windows
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        return ex.errno != errno.ESRCH
+    return True
+
+
+def read_legacy(path):
+    """Yield (src, dl) pairs from a tab-separated cache file."""
+    with open(path, 'rb') as f:
+        for cs in f:
+            try:
+                sl, fl = cs.strip().split()[:2]
+            except ValueError:
+                continue  # bad format
+            yield sl, fl
+
+
+class LinkCache(object):
+    """Link cache backed by an sqlite database.
+
+    All methods may be called from several threads. Writes go to the
+    database every BATCH links, on flush(), release() and at exit.
+    The links found are kept in memory, up to MAX_HOT of them, least
+    recently used ones are dropped first. Links older than ttl seconds
+    (if given) are not used and get replaced by new ones. When opened,
+    the database is cut down to the MAX_LINKS newest links; anything else
+    (expiry, dead links) is left to the maintenance commands.
+
+    Uploads are wrapped in claim() and release(), see claim().
+    """
+    BATCH = 50
+    MAX_HOT = 10000
+    MAX_LINKS = 200000
+
+    def __init__(self, path=CACHE_FILE, legacy=LEGACY_FILE, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hot = OrderedDict()  # src -> (dl, added), recently used last
+        self.pending = {}  # src -> dl, not written yet
+        self.stats = dict.fromkeys(STATS, 0)
+        # Transactions are explicit, see write().
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.text_factory = str
+        # Readers don't wait for writers.
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.write(self.create, legacy)
+        if self.MAX_LINKS and len(self) > self.MAX_LINKS:
+            self.shrink(self.MAX_LINKS)
+        atexit.register(self.flush)
+
+    def write(self, f, *args):
+        """Call f(*args) in a write transaction, return its result."""
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                r = f(*args)
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+        return r
+
+    def create(self, legacy):
+        """Create the tables, importing the old cache file into a new one."""
+        self.db.execute(INFLIGHT_SCHEMA)
+        self.db.execute(DIGESTS_SCHEMA)
+        cols = [c[1] for c in self.db.execute('PRAGMA table_info(links)')]
+        if not cols:
+            self.db.execute(SCHEMA)
+            if legacy and os.path.isfile(legacy):
+                self.insert(read_legacy(legacy), 'IGNORE')
+        elif 'added' not in cols:
+            # made by an older version
+            self.db.execute('ALTER TABLE links ADD COLUMN added REAL')
+            self.db.execute('UPDATE links SET added = ?', (time.time(),))
+        self.db.execute(INDEX_SCHEMA)
+
+    def insert(self, links, conflict='REPLACE'):
+        """Add (src, dl) pairs, replacing the old links of the sources
+        (conflict='REPLACE') or keeping them ('IGNORE')."""
+        now = time.time()
+        self.db.executemany(
+            'INSERT OR {0} INTO links VALUES (?, ?, ?)'.format(conflict),
+            ((src, dl, now) for (src, dl) in links))
+
+    def expired(self, added):
+        return self.ttl is not None and added < time.time() - self.ttl
+
+    def find(self, src, count=True):
+        """Return the link for src, or None. The lock must be held.
+        Lookups are counted in stats if count is true."""
+        hit = self.hot.pop(src, None)
+        if hit is not None:
+            if not self.expired(hit[1]):
+                self.hot[src] = hit
+                self.stats['hits'] += count
+                return hit[0]
+        else:
+            hit = self.db.execute('SELECT dl, added FROM links WHERE src = ?',
+                                  (src,)).fetchone()
+            if hit is not None and not self.expired(hit[1]):
+                self.remember(src, hit)
+                self.stats['db_hits'] += count
+                return hit[0]
+        self.stats['expired' if hit is not None else 'misses'] += count
+        return None
+
+    def remember(self, src, hit):
+        self.hot[src] = hit
+        if len(self.hot) > self.MAX_HOT:
+            self.hot.popitem(last=False)
+
+    def get(self, src):
+        """Return the download URL for src, or None."""
+        src = _key(src)
+        with self.lock:
+            return self.find(src)
+
+    def put(self, src, dl):
+        """Remember dl for src, unless src already has a link."""
+        src = _key(src)
+        with self.lock:
+            if self.find(src, False) is not None:
+                return
+            self.pending[src] = _key(dl)
+            self.remember(src, (self.pending[src], time.time()))
+            full = len(self.pending) >= self.BATCH
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write pending links to the database."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if pending:
+            self.write(self.insert, pending.items())
+
+    def get_digest(self, digest):
+        """Return the download URL of content with this digest, or None."""
+        with self.lock:
+            row = self.db.execute('SELECT dl, added FROM digests '
+                                  'WHERE digest = ?', (digest,)).fetchone()
+        if row is None or self.expired(row[1]):
+            return None
+        return row[0]
+
+    def put_digest(self, digest, dl, size):
+        """Remember that content with this digest and size is at dl."""
+        self.write(lambda: self.db.execute(
+            'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)',
+            (digest, _key(dl), size, time.time())))
+
+    def claim(self, src):
+        """Mark src as being uploaded by this process.
+
+        Return None if the caller is to upload src and then call
+        release(), or the link if some other worker has uploaded it.
+        While another upload of src is in flight, wait for it; if it
+        fails, the source is claimed for the caller.
+        """
+        while True:
+            r = self.write(self.mark, _key(src))
+            if r is not False:
+                return r
+            sleep(POLL)
+
+    def mark(self, src):
+        """Put the in-flight mark on src: return None if done, the link
+        if src is already uploaded, False if it is in flight."""
+        dl = self.find(src, False)
+        if dl is not None:
+            return dl
+        now = time.time()
+        row = self.db.execute('SELECT pid, started FROM inflight WHERE src = ?',
+                              (src,)).fetchone()
+        if row is not None and now - row[1] < STALE and _alive(row[0]):
+            return False
+        self.db.execute('INSERT OR REPLACE INTO inflight VALUES (?, ?, ?)',
+                        (src, os.getpid(), now))
+        return None
+
+    def release(self, src):
+        """Drop the in-flight mark on src, writing pending links first."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        self.write(self.unmark, _key(src), pending.items())
+
+    def unmark(self, src, links):
+        self.insert(links)
+        self.db.execute('DELETE FROM inflight WHERE src = ? AND pid = ?',
+                        (src, os.getpid()))
+
+    def __len__(self):
+        self.flush()
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM links').fetchone()[0]
+
+    # Maintenance
+
+    def drop(self, where, args=(), table='links'):
+        """Delete the rows matching an SQL condition, return their number."""
+        self.flush()
+        with self.lock:
+            self.hot.clear()
+        return self.write(lambda: self.db.execute(
+            'DELETE FROM {0} WHERE {1}'.format(table, where), args).rowcount)
+
+    def expire(self, ttl):
+        """Delete links and digests older than ttl seconds."""
+        since = time.time() - ttl
+        self.drop('added < ?', (since,), 'digests')
+        return self.drop('added < ?', (since,))
+
+    def drop_thumbs(self):
+        """Delete the links of generated thumbnails."""
+        return self.drop("src GLOB 't[0-9a-f]*.jpg' AND length(src) = 45")
+
+    def shrink(self, max_links):
+        """Delete the oldest links, leaving at most max_links."""
+        self.drop('digest IN (SELECT digest FROM digests ORDER BY added DESC '
+                  'LIMIT -1 OFFSET ?)', (max_links,), 'digests')
+        return self.drop('src IN (SELECT src FROM links ORDER BY added DESC '
+                         'LIMIT -1 OFFSET ?)', (max_links,))
+
+    def verify(self, alive, pattern=None):
+        """Delete links for which alive(link) is false; only links
+        matching the regexp pattern are checked if it is given."""
+        self.flush()
+        with self.lock:
+            rows = self.db.execute('SELECT src, dl FROM links').fetchall()
+        checked = {}
+        for (src, dl) in rows:
+            if dl not in checked and (pattern is None or re.match(pattern, dl)):
+                checked[dl] = alive(dl)
+        dead = [(dl,) for dl in checked if not checked[dl]]
+        if not dead:
+            return 0
+        with self.lock:
+            self.hot.clear()
+        def delete():
+            self.db.executemany('DELETE FROM digests WHERE dl = ?', dead)
+            return self.db.executemany('DELETE FROM links WHERE dl = ?',
+                                       dead).rowcount
+        return self.write(delete)
+
+    def compact(self):
+        """Drop stale in-flight marks and give the free space back."""
+        self.write(lambda: self.db.execute(
+            'DELETE FROM inflight WHERE started < ?', (time.time() - STALE,)))
+        with self.lock:
+            self.db.execute('VACUUM')
+            self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def info(self):
+        """Return a dict with the number of links, the database size
+        and the lookup statistics of this process."""
+        d = dict(self.stats)
+        d['links'] = len(self)
+        for t in ('inflight', 'digests'):
+            d[t] = self.db.execute('SELECT COUNT(*) FROM ' + t).fetchone()[0]
+        d['size'] = os.path.getsize(self.path)
+        return d
+
+
+def link_alive(url):
+    """Tell if a download link still works (True if we can't tell)."""
+    req = urllib2.Request(url)
+    req.get_method = lambda: 'HEAD'
+    try:
+        urllib2.urlopen(req, timeout=30).close()
+    except urllib2.HTTPError as ex:
+        return ex.code not in (404, 410)
+    except Exception:
+        pass  # network trouble, not the link's fault
+    return True
+
+
+if __name__ == '__main__':
+    import argparse
+    from rehost import DOWNLOAD_URL
+    p = argparse.ArgumentParser(description='Link cache maintenance')
+    p.add_argument(
+        'path', nargs='?', default=CACHE_FILE,
+        help='cache database (default: {0})'.format(os.path.basename(CACHE_FILE))
+    )
+    p.add_argument(
+        '--ttl', type=float, metavar='DAYS',
+        help='delete links older than DAYS days'
+    )
+    p.add_argument(
+        '--max', type=int, metavar='N', dest='max_links',
+        help='keep at most N newest links'
+    )
+    p.add_argument(
+        '--thumbs', action='store_true',
+        help='delete links of generated thumbnails'
+    )
+    p.add_argument(
+        '--verify', action='store_true',
+        help='check download links, delete the dead ones (slow)'
+    )
+    p.add_argument(
+        '--import', dest='legacy', metavar='FILE',
+        help='add links from an old tab-separated cache file'
+    )
+    a = p.parse_args()
+    c = LinkCache(a.path, None)
+    before = os.path.getsize(a.path)
+    if a.legacy:
+        c.write(c.insert, read_legacy(a.legacy), 'IGNORE')
+    if a.ttl is not None:
+        print('Expired:', c.expire(a.ttl * 86400))
+    if a.thumbs:
+        print('Thumbnails:', c.drop_thumbs())
+    if a.verify:
+        print('Dead:', c.verify(link_alive, DOWNLOAD_URL))
+    if a.max_links is not None:
+        print('Evicted:', c.shrink(a.max_links))
+    c.compact()
+    d = c.info()
+    print('{0} links, {1} digests, {2} in flight, {3} KB (was {4} KB)'.format(
+        d['links'], d['digests'], d['inflight'], d['size'] // 1024,
+        before // 1024))
@@ -11,21 +11,34 @@ import urllib2
 import string
 import random
 import argparse
-from urllib2 import build_opener, install_opener, urlopen, URLError
+from urllib2 import build_opener, install_opener, URLError
 from urlparse import urlparse
-from tempfile import TemporaryFile
+from tempfile import SpooledTemporaryFile
+from hashlib import sha1
 
 # from http://atlee.ca/software/poster/
 from encode import multipart_encode, MultipartParam, gen_boundary
-from streaminghttp import streaming_opener
+from streaminghttp import streaming_opener, KeepAliveHandler
+import linkcache
 
-__all__ = ['rehost', 'open_thing', 'print_urlerror', 'DOWNLOAD_URL']
+__all__ = ['rehost', 'open_thing', 'open_url', 'print_urlerror', 'DOWNLOAD_URL']
 
 USER_AGENT = 'Mozilla/5.0 (compatible)'
 UPLOAD_URL = 'http://file.kirovnet.ru/upload'
 DOWNLOAD_URL = r'http://file.kirovnet.ru/d/\d+'
 MAX_SIZE = 50 * 2 ** 20
+BUFSIZE = 2 ** 16
+SPOOL_SIZE = 2 ** 18  # downloads bigger than that go to disk
+# Pipe downloads of known length over SPOOL_SIZE straight into the upload.
+# Their content is then only known to be a duplicate after it is uploaded
+# again; smaller ones are checked against the digests first.
+STREAM_UPLOADS = True
 TIMEOUT = 60
+# Viewer pages are read until the direct link is found (see scan_page),
+# SCAN_LIMIT bytes at most.
+SCAN_LIMIT = 2 ** 20
+SCAN_CHUNK = 2 ** 14
+SCAN_MARGIN = 2 ** 12
 
 ERR = '[!]'
 FLAGS = '(?si)'
@@ -43,7 +56,8 @@ RW = (
     # http://pic.phyrefile.com/h/hd/hdlover/2009/12/09/7_002.png
     (   r'img\.phyrefile\.com/((\w)(\w)\w*)/(.*)',
         r'pic.phyrefile.com/\2/\2\3/\1/\4', 0),
-    (r'.*?(http://(?:www\.)?ag\.ru/screenshots/\w+/\d+).*', r'\1/big', 1),
+    # anchored, or every position of a mismatching URL is tried
+    (r'^.*?(http://(?:www\.)?ag\.ru/screenshots/\w+/\d+).*', r'\1/big', 1),
     # http://iceimg.com/0997a2a5e67e61.png.htm
     # http://iceimg.com/i/09/97/a2a5e67e61.png
     (r'(iceimg\.com)/(\w\w)(\w\w)(.+)\.htm$', r'\1/i/\2/\3/\4', 0),
@@ -70,12 +84,14 @@ IMAGE_EXT = ('.jpg', '.jpg', '.gif', '.bmp', '.png')
 
 cache_cfg = {}
 cache_cfg['enabled'] = True
-try:
-    cache_cfg['file'] = os.path.join(os.path.dirname(__file__), 'linkcache.txt')
-    with open(cache_cfg['file'], 'a+'):
-        pass
-except:
-    cache_cfg['enabled'] = False
+cache_cfg['file'] = linkcache.CACHE_FILE
+cache_cfg['ttl'] = None  # seconds a link is trusted for, forever if None
+cache_cfg['cache'] = None
+
+# Files found uploaded already by their content, and their total size.
+dedup_stats = {'files': 0, 'bytes': 0}
+CACHE_STATS_FMT = ('link cache: {hits} hits in memory, {db_hits} in the '
+                   'database, {misses} misses, {expired} expired')
 
 
 def print_urlerror(url, ex):
@@ -86,53 +102,168 @@ def print_urlerror(url, ex):
     print(ERR, 'Request to', url, 'failed:', msg)
 
 
-def uaopener(handler=urllib2.BaseHandler, uagent=USER_AGENT):
-    """Build an opener with spoofed user-agent."""
+def uaopener(handler=KeepAliveHandler, uagent=USER_AGENT):
+    """Build an opener with spoofed user-agent.
+    
+    Openers share the keep-alive connection pool of streaminghttp.
+    """
     op = build_opener(handler)
     op.addheaders = [('User-Agent', uagent)]
     return op
 
 
-# Every urlopen() will use our special opener instead of default one.
-install_opener(uaopener())
+# Shared by all requests (and greenlets), per-request headers go to
+# open_url(). Every urlopen() will use it instead of default one, too.
+opener = uaopener()
+install_opener(opener)
+upload_opener = streaming_opener()
+
+
+def open_url(url, referer='', timeout=TIMEOUT):
+    """Open an URL with the shared opener, sending referer (if given)
+    with this request only."""
+    req = urllib2.Request(url)
+    if referer:
+        req.add_header('Referer', referer)
+    return opener.open(req, timeout=timeout)
+
+
+def cache_open():
+    """Return the link cache, opening it on first use."""
+    if cache_cfg['cache'] is None:
+        try:
+            cache_cfg['cache'] = linkcache.LinkCache(cache_cfg['file'],
+                                                     ttl=cache_cfg['ttl'])
+        except Exception as ex:
+            print(ERR, 'Link cache disabled:', ex)
+            cache_cfg['enabled'] = False
+    return cache_cfg['cache']
 
 
 def cache_search(address):
     """Find out if object at this address is already rehosted."""
-    if not cache_cfg['enabled']:
+    if not cache_cfg['enabled'] or cache_open() is None:
         return None
-    with open(cache_cfg['file'], 'a+') as f:
-        for cs in f:
-            try:
-                sl, fl = cs.strip().split()[:2]
-                if sl == address:
-                    return fl
-            except ValueError:
-                pass  # bad format
+    return cache_cfg['cache'].get(address)
 
 
 def cache_write(src, dl):
     """Remember the download URL for re-use."""
-    if not cache_cfg['enabled']:
+    if not cache_cfg['enabled'] or cache_open() is None:
         return None
-    if src != dl and not cache_search(src):
-        with open(cache_cfg['file'], 'a+') as cf:
-            cf.write('{0}\t{1}\n'.format(src, dl))
+    if src != dl:
+        cache_cfg['cache'].put(src, dl)
+
+
+def cache_find_digest(digest):
+    """Find out if a file with this content is already rehosted."""
+    if not cache_cfg['enabled'] or cache_open() is None:
+        return None
+    return cache_cfg['cache'].get_digest(digest)
+
+
+def cache_write_digest(digest, dl, size):
+    """Remember the download URL of a file's content."""
+    if cache_cfg['enabled'] and cache_open() is not None:
+        cache_cfg['cache'].put_digest(digest, dl, size)
+
+
+def cache_claim(address):
+    """Mark address as being rehosted, see LinkCache.claim()."""
+    if not cache_cfg['enabled'] or cache_open() is None:
+        return None
+    return cache_cfg['cache'].claim(address)
+
+
+def cache_release(address):
+    """Drop the mark put by cache_claim()."""
+    if cache_cfg['cache'] is not None:
+        cache_cfg['cache'].release(address)
+
+
+def cache_stats():
+    """Return the lookup counts of the link cache (see linkcache.STATS)."""
+    if cache_cfg['cache'] is None:
+        return dict.fromkeys(linkcache.STATS, 0)
+    return dict(cache_cfg['cache'].stats)
 
 
-def open_thing(address, accept_types=None):
+def cache_flush():
+    """Write out the links remembered so far."""
+    if cache_cfg['cache'] is not None:
+        cache_cfg['cache'].flush()
+
+
+def copy_data(src, dst, digest=None, limit=None):
+    """Copy a file object to dst (None to just read it) in chunks,
+    feeding the data to digest (a hashlib object), if given.
+    
+    Return the number of bytes copied. Copying stops as soon as it
+    is over limit, if given.
+    """
+    size = 0
+    while limit is None or size <= limit:
+        b = src.read(BUFSIZE)
+        if not b:
+            break
+        size += len(b)
+        if digest is not None:
+            digest.update(b)
+        if dst is not None:
+            dst.write(b)
+    return size
+
+
+class Download(object):
+    """A response of known length, to be read straight into an upload.
+    
+    Reading it feeds digest (a hashlib object), if given. It can only be
+    rewound before it is read.
+    """
+    def __init__(self, response, length, digest=None):
+        self.response = response
+        self.length = length
+        self.digest = digest
+        self.size = 0
+    
+    def read(self, n=-1):
+        b = self.response.read(n)
+        self.size += len(b)
+        if self.digest is not None:
+            self.digest.update(b)
+        if not b and n != 0 and self.size < self.length:
+            raise IOError('download cut short at {0} of {1} bytes'.format(
+                self.size, self.length))
+        return b
+    
+    def seek(self, pos, whence=0):
+        if pos != 0 or whence != 0 or self.size > 0:
+            raise IOError('cannot rewind a download')
+    
+    def close(self):
+        self.response.close()
+
+
+def open_thing(address, accept_types=None, digest=None, referer='',
+               max_size=None, stream=False):
     """Try to open an URL or local file.
     
     Return a tuple (file, type, info), where:
     -- file: file object or None if an error occured
     -- type: MIME type (if known)
     -- info: httplib.HTTPMessage object (if present)
+    If digest (a hashlib object) is given, it is fed the file content.
+    URLs are requested with referer, if given, and downloaded only up
+    to max_size bytes, if given (file is None for a bigger one). If
+    stream is true, an URL of known length over SPOOL_SIZE is not
+    downloaded at all: file is a Download to be read once, and digest is
+    fed as it is read.
     """
     f, t, i = None, None, None
     pa = urlparse(address)
     if pa.scheme in ['http', 'https', 'ftp']:
         try:
-            tmp = urlopen(address, timeout=TIMEOUT)
+            tmp = open_url(address, referer)
         except URLError as ex:
             print_urlerror(address, ex)
             return (f, t, i)
@@ -143,21 +274,43 @@ def open_thing(address, accept_types=None):
         i.url = tmp.url
         t = i.gettype()
         if accept_types is not None and t not in accept_types:
+            tmp.close()
+            return (f, t, i)
+        length = i.getheader('Content-Length', '')
+        if max_size is not None and length.isdigit() and int(length) > max_size:
+            print(ERR, 'Too big object:', address)
+            tmp.close()  # don't download it at all
             return (f, t, i)
+        if stream and length.isdigit() and int(length) > SPOOL_SIZE:
+            return (Download(tmp, int(length), digest), t, i)
         try:
-            f = TemporaryFile()
-            f.write(tmp.read())
+            f = SpooledTemporaryFile(SPOOL_SIZE)
+            size = copy_data(tmp, f, digest, max_size)
+            if max_size is not None and size > max_size:
+                print(ERR, 'Too big object:', address)
+                f.close()
+                return (None, t, i)
+            if length.isdigit() and size < int(length):
+                print(ERR, 'Failed to read', address + ':', 'download cut '
+                      'short at {0} of {1} bytes'.format(size, length))
+                f.close()
+                return (None, t, i)
             f.flush()
             f.seek(0)
         except Exception as ex:
             print(ERR, ex)
             return (None, None, None)
+        finally:
+            tmp.close()
     else:
         # Unknown protocol, suppose it's local file path.
         fp = os.path.normpath(address)
         if os.path.isfile(fp):
             try:
                 f = open(fp, 'rb')
+                if digest is not None:
+                    copy_data(f, None, digest)
+                    f.seek(0)
             except IOError as ex:
                 print(ERR, 'I/O error.', ex)
         else:
@@ -165,33 +318,124 @@ def open_thing(address, accept_types=None):
     return (f, t, i)
 
 
-def recover_image(url):
-    """Apply URL-rewriting rules in effort to get direct link."""
-    for (L, R, C) in RW:
-        dlink = re.sub(L, R, url)
+# host name at the start of a rule pattern, and in an URL
+host_re = re.compile(r'\(?((?:\w[\w-]*\\\.)+\w+)(?:\)|/|$)')
+url_host_re = re.compile(r'[\w+.-]+://(?:[^/?#@]*@)?([^/?#:]*)')
+
+
+def rule_host(pattern):
+    """Return the host a rule pattern starts with (fastpic.ru for
+    r'fastpic\.ru/view/...'), or None if it may match any URL."""
+    m = host_re.match(pattern)
+    if m is None:
+        return None
+    return m.group(1).replace('\\.', '.').lower()
+
+
+class HostRules(object):
+    """URL rules (tuples starting with a pattern), indexed by host.
+    
+    Patterns are compiled once. A rule whose pattern starts with a host
+    name is only tried on URLs of that host and its subdomains, other
+    rules are tried on every URL. for_url() returns the rules to try,
+    in their original order; the order is remembered per host.
+    """
+    MAX_MEMO = 1000
+
+    def __init__(self, rules):
+        self.rules = [(re.compile(r[0]),) + tuple(r[1:]) for r in rules]
+        self.always = []
+        self.hosts = {}  # host -> [rule index]
+        for (i, r) in enumerate(rules):
+            h = rule_host(r[0])
+            if h is None:
+                self.always.append(i)
+            else:
+                self.hosts.setdefault(h, []).append(i)
+        self.order = {}
+
+    def for_url(self, url):
+        m = url_host_re.match(url)
+        host = m.group(1).lower() if m is not None else ''
+        order = self.order.get(host)
+        if order is None:
+            order = list(self.always)
+            labels = host.split('.')
+            for i in range(len(labels)):
+                order += self.hosts.get('.'.join(labels[i:]), [])
+            order.sort()
+            if len(self.order) >= self.MAX_MEMO:
+                self.order.clear()
+            self.order[host] = order
+        return [self.rules[i] for i in order]
+
+
+rw_rules = HostRules(RW)
+rw_ext_rules = HostRules([(L, re.compile(FLAGS + R)) for (L, R) in RW_EXT])
+
+
+def rewrite_url(url):
+    """Apply URL-rewriting rules without network I/O.
+    
+    Return (url, final): final is false if the direct link may be on
+    the page at url (see RW_EXT) and the page has to be fetched.
+    """
+    for (L, R, C) in rw_rules.for_url(url):
+        dlink = L.sub(R, url)
         if dlink != url:
             if C == 0:
-                return dlink
+                return (dlink, True)
             else:  # continue rewriting
                 url = dlink
                 break
+    return (url, not rw_ext_rules.for_url(url))
+
+
+def scan_page(page, pattern, limit=SCAN_LIMIT):
+    """Read a file object until pattern is found in it.
+    
+    Return the match object or None. At most limit bytes are read, in
+    blocks as big as what was read before, so the data is searched
+    about twice in all. A match is taken once SCAN_MARGIN bytes follow
+    it (or at the end of file), since its greedy parts may go on.
+    """
+    buf = ''
+    while True:
+        n = min(max(len(buf), SCAN_CHUNK), limit - len(buf))
+        b = page.read(n) if n > 0 else ''
+        buf += b
+        end = len(b) < n or n == 0  # short read: end of file
+        m = pattern.search(buf)
+        if m is not None and (m.end() + SCAN_MARGIN <= len(buf) or end):
+            return m
+        if end:
+            return None
+
+
+def recover_image(url, referer=''):
+    """Apply URL-rewriting rules in effort to get direct link."""
+    url, final = rewrite_url(url)
+    if final:
+        return url
     try:
-        page = urlopen(url)
+        page = open_url(url, referer)
     except URLError as ex:
         print_urlerror(url, ex)
         return url
     except:
         return url
-    for (L, R) in RW_EXT:
-        if re.search(L, page.url) is None:
-            continue
-        try:
-            p = page.read()
-            return re.search(FLAGS + R, p).group(1)
-        except (AttributeError, IndexError, URLError) as e:
-            print(ERR, 'Failed to get direct URL:', page.url)
-            return url
-    return url
+    try:
+        for (L, R) in rw_ext_rules.for_url(page.url):
+            if L.search(page.url) is None:
+                continue
+            try:
+                return scan_page(page, R).group(1)
+            except (AttributeError, IndexError, URLError) as e:
+                print(ERR, 'Failed to get direct URL:', page.url)
+                return url
+        return url
+    finally:
+        page.close()
 
 
 def rehost(url, force_cache=False, image=False, referer=''):
@@ -204,22 +448,72 @@ def rehost(url, force_cache=False, image=False, referer=''):
     cl = cache_search(url)
     if cl is not None:
         return cl  # already in cache
-    
+    cl = cache_claim(url)
+    if cl is not None:
+        return cl  # somebody else has just rehosted it
+    try:
+        return upload(url, force_cache, image, referer)
+    finally:
+        cache_release(url)
+
+
+def upload(url, force_cache=False, image=False, referer=''):
+    """Rehost an URL or file without looking into the cache first."""
     if image:
-        s = recover_image(url)
+        s = recover_image(url, referer)
         ts = IMAGE_TYPES
     else:
         s = url
         ts = None
     
-    if referer:
-        op = uaopener()
-        op.addheaders += [('Referer', referer)]
-        install_opener(op)
-    
-    fd, ftype, finfo = open_thing(s, accept_types=ts)
+    h = sha1()
+    fd, ftype, finfo = open_thing(s, accept_types=ts, digest=h,
+                                  referer=referer, max_size=MAX_SIZE,
+                                  stream=STREAM_UPLOADS)
+    if fd is None and image and finfo is not None and finfo.url != s \
+            and rw_ext_rules.for_url(finfo.url):
+        # redirected to a page with the direct link on it
+        s = recover_image(finfo.url, referer)
+        fd, ftype, finfo = open_thing(s, accept_types=ts, digest=h,
+                                      referer=referer, max_size=MAX_SIZE,
+                                      stream=STREAM_UPLOADS)
     if fd is None:
-        return url  # failed to open or wrong type
+        return url  # failed to open, wrong type or too big
+    streamed = isinstance(fd, Download)
+    try:
+        if streamed:
+            size = fd.length  # the digest is known once it is uploaded
+        else:
+            # no fstat(), a download may still be in memory
+            fd.seek(0, 2)
+            size = fd.tell()
+            fd.seek(0)
+            g = cache_find_digest(h.hexdigest())
+            if g is not None:
+                # Same content, linked from somewhere else.
+                dedup_stats['files'] += 1
+                dedup_stats['bytes'] += size
+                if force_cache or finfo is not None:
+                    cache_write(url, g)
+                return g
+        g = post_file(s, fd, ftype, finfo, image, size)
+    finally:
+        fd.close()
+    if g is None:
+        return url  # falling back
+    
+    if streamed:
+        # keep one link for the same content
+        g = cache_find_digest(h.hexdigest()) or g
+    cache_write_digest(h.hexdigest(), g, size)
+    if force_cache or finfo is not None:
+        cache_write(url, g)
+    return g
+
+
+def post_file(s, fd, ftype, finfo, image, size):
+    """Upload an opened file (see open_thing), return its download URL
+    or None."""
     if finfo is not None:
         fname = ''.join(random.sample(string.lowercase, 6))
         e = re.search(r'\.\w+$', finfo.url)
@@ -232,34 +526,33 @@ def rehost(url, force_cache=False, image=False, referer=''):
         fname += e
     else:
         fname = fd.name
-    pf = MultipartParam('file', filetype=ftype, fileobj=fd, filename=fname)
+    pf = MultipartParam('file', filetype=ftype, fileobj=fd, filename=fname,
+                        filesize=size)
     if pf.get_size(gen_boundary()) > MAX_SIZE:
         print(ERR, 'Too big object:', s)
-        return url
+        return None
     datagen, headers = multipart_encode([pf])
     req = urllib2.Request(UPLOAD_URL, datagen, headers)
     try:
-        pd = streaming_opener().open(req, timeout=TIMEOUT)
+        pd = upload_opener.open(req, timeout=TIMEOUT)
         page = pd.read().decode(pd.info().getparam('charset'))
     except URLError as ex:
         print_urlerror(UPLOAD_URL, ex)
-        return url
+        return None
+    except IOError as ex:
+        print(ERR, 'Failed to read', s + ':', ex)
+        return None
     
     g = re.search(FLAGS + DOWNLOAD_URL, page)
     if g:
-        g = g.group(0)
+        return g.group(0)
+    g = re.search(FLAGS + '<div id="error">(.*?)</div>', page)
+    if g:
+        g = re.sub('<[^>]+>', '', g.group(1)).strip()
+        print(ERR, 'file.kirovnet.ru says:', g)
     else:
-        g = re.search(FLAGS + '<div id="error">(.*?)</div>', page)
-        if g:
-            g = re.sub('<[^>]+>', '', g.group(1)).strip()
-            print(ERR, 'file.kirovnet.ru says:', g)
-        else:
-            print(ERR, 'Failed to get URL (layout changed?)')
-        return url    # falling back
-    
-    if force_cache or finfo is not None:
-        cache_write(url, g)
-    return g
+        print(ERR, 'Failed to get URL (layout changed?)')
+    return None
 
 
 if __name__ == '__main__':
@@ -293,5 +586,11 @@ if __name__ == '__main__':
     for arg in a.targets:
         t += [rehost(arg, image=a.image, force_cache=a.force_cache)]
     print('\n'.join(t), file=a.output)
+    if dedup_stats['files']:
+        print('{0} files were already uploaded, {1} KB saved'.format(
+            dedup_stats['files'], dedup_stats['bytes'] // 1024), file=sys.stderr)
+    st = cache_stats()
+    if any(st.values()):
+        print(CACHE_STATS_FMT.format(**st), file=sys.stderr)
     if a.output == sys.stdout and os.name == 'nt':
         sys.stdin.readline()
@@ -0,0 +1,297 @@
+# 2010 atomizer
+"""Replacement rules: loading, compiling and choosing them by site.
+
+The rules live in rules.txt (see the comments there for the format).
+The parsed file is cached in rules.cache and re-read only when rules.txt
+changes; the rules that apply to a host are compiled once per process
+and shared with every other host they apply to.
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import ast
+import cPickle as pickle
+from urlparse import urlparse
+
+__all__ = ['RuleSet', 'RuleTable', 'compile_simple', 'literal_prefix',
+           'literal_keys', 'load', 'for_host', 'FLAGS']
+
+FLAGS = '(?si)'
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules.txt')
+CACHE_FILE = os.path.join(os.path.dirname(RULES_FILE), 'rules.cache')
+CACHE_VERSION = 1
+
+LIST_KEYS = ('hosts', 'posts', 'simple', 'complex', 'skip_tags', 'skip_attr',
+             'closed_tags', 'flatten')
+DICT_KEYS = ('tags', 'colors')
+KEYS = LIST_KEYS + DICT_KEYS + ('name', 'poster_fix')
+
+_loaded = {}  # path -> (stamp, sections)
+_rulesets = {}  # (stamp, indices of applicable sections) -> RuleSet
+
+
+def _alt(patterns):
+    """Join patterns into an alternation that never matches if empty."""
+    return '|'.join(patterns) or '(?!)'
+
+
+def literal_prefix(pattern):
+    """Return the literal text every match of pattern starts with."""
+    lit = []
+    for c in pattern:
+        if c in '.^$*+?{}[]|()\\':
+            if c in '*?{' and lit:
+                lit.pop()  # previous char is optional
+            break
+        lit.append(c)
+    return ''.join(lit)
+
+
+def literal_keys(pattern):
+    """Return literal strings (lowercase) found in every match of pattern.
+    
+    Only the top level of the pattern is looked at; a top-level
+    alternation gives no keys at all.
+    """
+    keys, lit, depth, i = [], [], 0, 0
+    def flush():
+        if lit:
+            keys.append(''.join(lit).lower())
+            del lit[:]
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == '\\':
+            c = pattern[i:i + 1]
+            i += 1
+            if depth == 0 and c and not c.isalnum():
+                lit.append(c)  # escaped punctuation
+            else:
+                flush()
+        elif c == '[':
+            # skip the class, a leading ']' is a part of it
+            i = pattern.find(']', i + 1 + (pattern[i:i + 1] in '^')) + 1 or len(pattern)
+            flush()
+        elif c == '(':
+            depth += 1
+            flush()
+        elif c == ')':
+            depth -= 1
+            flush()
+        elif c == '|' and depth == 0:
+            return []
+        elif c in '*?{':
+            if depth == 0 and lit:
+                lit.pop()  # previous char is optional
+            if c == '{':
+                i = pattern.find('}', i) + 1 or len(pattern)
+            flush()
+        elif c in '.^$+|':
+            flush()
+        elif depth == 0:
+            lit.append(c)
+    flush()
+    return keys
+
+
+class RuleTable(object):
+    """Compiled complex rules, indexed by the literal text of each rule.
+
+    match() looks up which rule keys are present in the attribute string
+    and tests only the rules that can possibly match, in their original
+    order. Rules without a literal key are always tested. Results are
+    remembered per attribute string, since posts repeat them a lot.
+    """
+    MAX_MEMO = 1000
+
+    def __init__(self, rules):
+        self.rules = [(re.compile(FLAGS + p), (op, cl)) for (p, op, cl) in rules]
+        keys = [literal_prefix(r[0]).lower() for r in rules]
+        self.always = [i for (i, k) in enumerate(keys) if not k]
+        self.keys = [(k, i) for (i, k) in enumerate(keys) if k]
+        self.order = {}
+        self.memo = {}
+
+    def match(self, attr):
+        """Return (tags, match object) for the first matching rule,
+        or (None, None)."""
+        r = self.memo.get(attr)
+        if r is not None:
+            return r
+        a = attr.lower()
+        found = tuple([i for (k, i) in self.keys if k in a])
+        order = self.order.get(found)
+        if order is None:
+            order = self.order[found] = sorted(self.always + list(found))
+        r = None, None
+        for i in order:
+            dm = self.rules[i][0].search(attr)
+            if dm is not None:
+                r = self.rules[i][1], dm
+                break
+        if len(self.memo) >= self.MAX_MEMO:
+            self.memo.clear()
+        self.memo[attr] = r
+        return r
+
+
+def compile_simple(rules):
+    """Compile (pattern, replacement) pairs into a few fused regexps.
+
+    Return a list of (regexp, replacement) to be applied in order.
+    Deletions may glue together text that later rules look for, so the
+    rules following a deletion start a new pass. Patterns must not use
+    backreferences, replacements may.
+    """
+    passes = []
+    for (k, r) in rules:
+        if not passes or (r and not passes[-1][-1][1]):
+            passes.append([])
+        passes[-1].append((k, r))
+    compiled = []
+    for rs in passes:
+        fused = '|'.join(['(?P<r{0}>{1})'.format(i, k)
+                          for (i, (k, r)) in enumerate(rs)])
+        first = set([literal_prefix(k)[:1].lower() for (k, r) in rs])
+        if '' not in first:
+            # Don't try every alternative at every position.
+            fused = '(?=[{0}])(?:{1})'.format(
+                re.escape(''.join(sorted(first))), fused)
+        fused = re.compile(FLAGS + fused)
+        subs = {}
+        for (i, (k, r)) in enumerate(rs):
+            n = fused.groupindex['r{0}'.format(i)]
+            # Shift group numbers to their place in the fused regexp.
+            subs['r{0}'.format(i)] = re.sub(r'\\(\d+)',
+                lambda m: '\\g<{0}>'.format(n + int(m.group(1))), r)
+        def repl(m, subs=subs):
+            r = subs[m.lastgroup]
+            if '\\' in r:
+                return m.expand(r)
+            return r
+        compiled.append((fused, repl))
+    return compiled
+
+
+class RuleSet(object):
+    """Rules for one site, merged from all applicable sections and compiled.
+
+    The merged source lists and dicts are kept in `data`.
+    """
+    def __init__(self, sections, host=''):
+        applies = [sections[i] for i in _applicable(sections, host)]
+        self.names = [s['name'] for s in applies]
+        data = dict([(k, []) for k in LIST_KEYS] + [(k, {}) for k in DICT_KEYS])
+        data['poster_fix'] = False
+        for s in applies:
+            for k in LIST_KEYS:
+                data[k] = list(s.get(k, [])) + data[k]
+            for k in DICT_KEYS:
+                data[k].update(s.get(k, {}))
+            data['poster_fix'] = s.get('poster_fix', data['poster_fix'])
+        # Generic post patterns first, then the site ones, then the rest.
+        posts = [p for s in applies if not s.get('hosts') for p in s.get('posts', [])]
+        posts += [p for s in applies if s.get('hosts') for p in s.get('posts', [])]
+        posts += [p for s in sections if s not in applies for p in s.get('posts', [])]
+        data['posts'] = posts
+        self.data = data
+
+        self.posts = [re.compile(FLAGS + p) for p in posts]
+        # Text a page must contain for a post pattern to match at all.
+        self.post_keys = [literal_keys(p) for p in posts]
+        self.simple = compile_simple(data['simple'])
+        self.complex = RuleTable(data['complex'])
+        # One at a time: removing one tag may change where another ends.
+        self.skip_tags = [re.compile(FLAGS +
+            r'\s*<(?P<tag>{0}).*?</(?P=tag)>\s*'.format(t))
+            for t in data['skip_tags']]
+        self.skip_attr_re = re.compile(_alt(data['skip_attr']))
+        self.closed_re = re.compile(FLAGS +
+            r'<((?:{0})[^>]*?)/?>'.format(_alt(data['closed_tags'])))
+        self.unclosed_re = re.compile(
+            r'</(?:{0})>'.format(_alt(data['closed_tags'])))
+        self.flatten_re = None
+        if data['flatten']:
+            self.flatten_re = re.compile(_alt(data['flatten']))
+        self.tags = dict([(k.lower(), tuple(v)) for (k, v) in data['tags'].items()])
+        self.colors = data['colors']
+        self.poster_fix = data['poster_fix']
+
+
+def _applicable(sections, host):
+    """Return indices of the sections for the host: the generic ones and
+    the ones listing a part of it."""
+    host = host.lower()
+    return [i for (i, s) in enumerate(sections) if not s.get('hosts') or
+            any([h in host for h in s['hosts']])]
+
+
+def _check(sections):
+    """Make sure the parsed rules file looks sane."""
+    if not isinstance(sections, list):
+        raise ValueError('rules file must contain a list of sections')
+    for s in sections:
+        if not isinstance(s, dict) or 'name' not in s:
+            raise ValueError('every section must be a dict with a name')
+        for k in s:
+            if k not in KEYS:
+                raise ValueError('unknown key "{0}" in section "{1}"'.format(
+                    k, s['name']))
+        for k in LIST_KEYS:
+            if not isinstance(s.get(k, []), (list, tuple)):
+                raise ValueError('"{0}" in section "{1}" must be a list'.format(
+                    k, s['name']))
+        for k in DICT_KEYS:
+            if not isinstance(s.get(k, {}), dict):
+                raise ValueError('"{0}" in section "{1}" must be a dict'.format(
+                    k, s['name']))
+    return sections
+
+
+def load(path=RULES_FILE, cache=CACHE_FILE):
+    """Return the list of sections from the rules file.
+
+    The parsed file is kept in memory and pickled to the cache file,
+    both are used while the rules file's mtime and size stay the same.
+    """
+    st = os.stat(path)
+    stamp = (CACHE_VERSION, path, st.st_mtime, st.st_size)
+    if path in _loaded and _loaded[path][0] == stamp:
+        return _loaded[path][1]
+    sections = None
+    if cache:
+        try:
+            with open(cache, 'rb') as f:
+                cstamp, sections = pickle.load(f)
+            if cstamp != stamp:
+                sections = None
+        except Exception:
+            sections = None
+    if sections is None:
+        with open(path, 'rU') as f:
+            sections = _check(ast.literal_eval(f.read()))
+        if cache:
+            try:
+                with open(cache, 'wb') as f:
+                    pickle.dump((stamp, sections), f, pickle.HIGHEST_PROTOCOL)
+            except (IOError, OSError):
+                pass  # read-only install, no big deal
+    _loaded[path] = (stamp, sections)
+    return sections
+
+
+def for_host(site, path=RULES_FILE):
+    """Return the RuleSet for a site, given by URL or host name."""
+    host = urlparse(site).netloc if '//' in site else site
+    sections = load(path)
+    stamp = _loaded[path][0]
+    # Hosts the same sections apply to share a RuleSet, so there are no
+    # more of them than section combinations, however many hosts come.
+    key = (stamp, tuple(_applicable(sections, host)))
+    if key not in _rulesets:
+        for k in [k for k in _rulesets if k[0][1] == path and k[0] != stamp]:
+            del _rulesets[k]  # compiled from an older rules file
+        _rulesets[key] = RuleSet(sections, host)
+    return _rulesets[key]
@@ -24,23 +24,169 @@ Example usage:
 
 >>> req = urllib2.Request("http://localhost:5000", f,
 ...                       {'Content-Length': str(len(s))})
+
+Bodies of unknown length can be sent with chunked transfer encoding
+instead, by an opener made with ``streaming_opener(chunked=True)``. If a
+server rejects such a request, it is sent again with a Content-Length,
+when the body can be rewound (see :meth:`StreamingHTTPHandler.http_open`).
+
+Connections are kept alive and reused: :class:`KeepAliveHandler` (and
+:class:`StreamingHTTPHandler`, which is based on it) take connections from
+a :class:`ConnectionPool`, shared by all handlers unless given their own.
 """
 
-import httplib, urllib2, socket
+import httplib, urllib2, socket, threading, time, os, errno, sys
+from tempfile import SpooledTemporaryFile
+from encode import FileSection
 from httplib import NotConnected
+from cStringIO import StringIO
+
+try:
+    from gevent import sleep
+    from gevent.select import select
+except ImportError:
+    from time import sleep
+    from select import select
+
+# Python 2 has no os.sendfile(), call the Linux one
+_sendfile = None
+if sys.platform.startswith('linux'):
+    try:
+        import ctypes, ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _sendfile = _libc.sendfile64
+        _sendfile.argtypes = (ctypes.c_int, ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t)
+        _sendfile.restype = ctypes.c_ssize_t
+    except (ImportError, OSError, AttributeError):
+        _sendfile = None
+    MSG_MORE = getattr(socket, 'MSG_MORE', 0x8000)
 
 __all__ = ['StreamingHTTPConnection', 'StreamingHTTPRedirectHandler',
-        'StreamingHTTPHandler', 'register_openers']
+        'StreamingHTTPHandler', 'register_openers', 'ConnectionPool',
+        'KeepAliveHandler', 'default_pool']
+
+MAX_PER_HOST = 6    # connections to a host at once
+IDLE_TIMEOUT = 15   # seconds an idle connection is kept
+WAIT_TIMEOUT = 30   # seconds to wait for a free connection before opening
+                    # one over the limit
+POLL = 0.05
+MAX_DRAIN = 2 ** 16  # bodies up to that size are read rather than dropped
+SPOOL_SIZE = 2 ** 20  # bodies resent with a Content-Length go to disk
+                      # when bigger than that
+# Responses to a chunked request that mean the server does not take them
+CHUNKED_REJECTED = (411, 501)
+SENDFILE_BLOCK = 2 ** 20  # bytes per sendfile() call, for progress callbacks
+SEND_BUFFER = 2 ** 16   # small writes of a request are gathered up to this
+
+class ConnectionPool(object):
+    """Keep-alive HTTP connections, grouped by connection class and host.
+
+    At most ``per_host`` connections to a host are in use at once, others
+    wait for a free one (for ``wait`` seconds at most). Idle connections
+    are dropped after ``idle_timeout`` seconds. Thread and greenlet safe.
+    """
+    def __init__(self, per_host=MAX_PER_HOST, idle_timeout=IDLE_TIMEOUT,
+                 wait=WAIT_TIMEOUT):
+        self.per_host = per_host
+        self.idle_timeout = idle_timeout
+        self.wait = wait
+        self.lock = threading.Lock()
+        self.idle = {}  # key -> [(connection, time it was put back)]
+        self.busy = {}  # key -> number of connections in use
+
+    def get(self, key, factory):
+        """Return ``(connection, reused)``, making a new connection with
+        ``factory()`` if there is no idle one."""
+        deadline = time.time() + self.wait
+        while True:
+            now = time.time()
+            stale = []
+            with self.lock:
+                idle = self.idle.get(key, [])
+                while idle and now - idle[0][1] > self.idle_timeout:
+                    stale.append(idle.pop(0)[0])
+                busy = self.busy.get(key, 0)
+                if idle or busy < self.per_host or now > deadline:
+                    self.busy[key] = busy + 1
+                    # the most recently used one is the least likely
+                    # to be closed by the server
+                    conn = idle.pop()[0] if idle else None
+                    break
+            for c in stale:
+                c.close()
+            sleep(POLL)
+        for c in stale:
+            c.close()
+        if conn is not None:
+            return conn, True
+        return factory(), False
+
+    def put(self, key, conn, reuse=True):
+        """Give a connection back, closing it unless ``reuse`` is true."""
+        with self.lock:
+            self.busy[key] -= 1
+            if reuse:
+                self.idle.setdefault(key, []).append((conn, time.time()))
+        if not reuse:
+            conn.close()
+
+    def clear(self):
+        """Close all idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for (c, t) in conns:
+                c.close()
+
+default_pool = ConnectionPool()
+
+class PooledResponse(httplib.HTTPResponse):
+    """HTTP response that gives its connection back to the pool once it
+    has been read to the end, or closes it if closed before that."""
+    release = None
+
+    def read(self, amt=None):
+        self.reading = True
+        try:
+            s = httplib.HTTPResponse.read(self, amt)
+        except:
+            self.reading = False
+            self.done(False)
+            raise
+        self.reading = False
+        if self.fp is None:
+            self.done(not self.will_close)
+        return s
+
+    def close(self):
+        if self.release is not None and self.fp is not None and \
+                not getattr(self, 'reading', False) and not self.will_close \
+                and self.length is not None and self.length <= MAX_DRAIN:
+            # cheaper to read the rest than to connect again
+            try:
+                self.read()
+            except (socket.error, httplib.HTTPException):
+                pass
+        httplib.HTTPResponse.close(self)
+        if not getattr(self, 'reading', False):
+            self.done(False)
+
+    def done(self, reuse):
+        release, self.release = self.release, None
+        if release is not None:
+            release(reuse)
 
 class _StreamingHTTPMixin:
     """Mixin class for HTTP and HTTPS connections that implements a streaming
     send method."""
-    def send(self, value):
+    def send(self, value, head=None):
         """Send ``value`` to the server.
 
         ``value`` can be a string object, a file-like object that supports
         a .read() method, or an iterable object that supports a .next()
-        method.
+        method. ``head`` (the request headers) is sent before it, in the
+        same write as its first bytes.
         """
         # Based on python 2.6's httplib.HTTPConnection.send()
         if self.sock is None:
@@ -58,6 +204,16 @@ class _StreamingHTTPMixin:
             print "send:", repr(value)
         try:
             blocksize = 8192
+            out = _SendBuffer(self.sock, SEND_BUFFER)
+            if head is not None:
+                out.write(head)
+            # the body of a chunked request (headers are a string)
+            chunked = self._chunked and not isinstance(value, str)
+            if chunked:
+                self._chunked = False
+                sendall = lambda data: self._send_chunk(out, data)
+            else:
+                sendall = out.write
             if hasattr(value, 'read') :
                 if hasattr(value, 'seek'):
                     value.seek(0)
@@ -65,25 +221,208 @@ class _StreamingHTTPMixin:
                     print "sendIng a read()able"
                 data = value.read(blocksize)
                 while data:
-                    self.sock.sendall(data)
+                    sendall(data)
                     data = value.read(blocksize)
             elif hasattr(value, 'next'):
                 if hasattr(value, 'reset'):
                     value.reset()
                 if self.debuglevel > 0:
                     print "sendIng an iterable"
-                for data in value:
-                    self.sock.sendall(data)
+                if _sendfile is not None and hasattr(value, 'blocks'):
+                    # the data of files goes from the kernel straight
+                    # to the socket
+                    for data in value.blocks():
+                        if isinstance(data, FileSection):
+                            self._send_section(out, data, chunked)
+                        else:
+                            sendall(data)
+                else:
+                    for data in value:
+                        sendall(data)
             else:
-                self.sock.sendall(value)
+                sendall(value)
+            if chunked:
+                out.write("0\r\n\r\n")
+            out.flush()
         except socket.error, v:
             if v[0] == 32:      # Broken pipe
                 self.close()
             raise
 
-class StreamingHTTPConnection(_StreamingHTTPMixin, httplib.HTTPConnection):
-    """Subclass of `httplib.HTTPConnection` that overrides the `send()` method
-    to support iterable body objects"""
+    def _send_output(self, message_body=None):
+        # as in httplib, but a body that is not a string is sent along
+        # with the headers too
+        self._buffer.extend(("", ""))
+        msg = "\r\n".join(self._buffer)
+        del self._buffer[:]
+        if isinstance(message_body, str):
+            msg += message_body
+            message_body = None
+        if message_body is None:
+            self.send(msg)
+        else:
+            self.send(message_body, msg)
+
+    _chunked = False
+
+    def putheader(self, header, *values):
+        if header.lower() == 'transfer-encoding' and 'chunked' in values:
+            self._chunked = True
+        httplib.HTTPConnection.putheader(self, header, *values)
+
+    def _send_chunk(self, out, data):
+        if data:  # an empty chunk would end the body
+            out.write("%x\r\n" % len(data))
+            out.write(data)
+            out.write("\r\n")
+
+    def _send_section(self, out, section, chunked=False):
+        """Send a :class:`encode.FileSection` with sendfile()"""
+        if chunked and section.size:
+            out.write("%x\r\n" % section.size)
+        # what is buffered goes in the same packet as the file data
+        out.flush(MSG_MORE)
+        out_fd, in_fd = self.sock.fileno(), section.fileobj.fileno()
+        timeout = self.sock.gettimeout()
+        offset = ctypes.c_int64(section.offset)
+        left = section.size
+        while left > 0:
+            n = _sendfile(out_fd, in_fd, ctypes.byref(offset),
+                          min(left, SENDFILE_BLOCK))
+            if n < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err != errno.EAGAIN:
+                    raise socket.error(err, os.strerror(err))
+                # a socket with a timeout (or any, under gevent) is
+                # non-blocking
+                if not select([], [self.sock], [], timeout)[1]:
+                    raise socket.timeout('timed out')
+                continue
+            if n == 0:
+                raise IOError('file is shorter than it was')
+            left -= n
+            section.sent(n)
+        if chunked and section.size:
+            out.write("\r\n")
+
+class _SendBuffer(object):
+    """Gathers small writes to a socket into one send.
+
+    Data that does not fit goes to the socket as it is, after topping up
+    and sending what is buffered. Call :meth:`flush` at the end."""
+    def __init__(self, sock, size):
+        self.sock = sock
+        self.size = size
+        self.buf = bytearray(size)
+        self.length = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            # as socket.sendall() would take it
+            data = str(data)
+        if self.length and self.length + len(data) > self.size:
+            room = self.size - self.length
+            self.buf[self.length:] = buffer(data, 0, room)
+            self.sock.sendall(self.buf)
+            self.length = 0
+            data = buffer(data, room)
+        n = len(data)
+        if n < self.size:
+            self.buf[self.length:self.length + n] = data
+            self.length += n
+        elif n:
+            self.sock.sendall(data)
+
+    def flush(self, flags=0):
+        if self.length:
+            self.sock.sendall(buffer(self.buf, 0, self.length), flags)
+            self.length = 0
+
+class KeepAliveHTTPConnection(httplib.HTTPConnection):
+    """`httplib.HTTPConnection` that can go back to a `ConnectionPool`"""
+    response_class = PooledResponse
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        # A kept-alive connection sends requests in several small writes
+        # and must not wait for the ACK of the previous one (Nagle).
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+class StreamingHTTPConnection(_StreamingHTTPMixin, KeepAliveHTTPConnection):
+    """Subclass of `KeepAliveHTTPConnection` that overrides the `send()`
+    method to support iterable body objects"""
+
+class KeepAliveHandler(urllib2.HTTPHandler):
+    """Subclass of `urllib2.HTTPHandler` that keeps connections alive
+    and takes them from a `ConnectionPool`.
+
+    A request on a reused connection that the server has closed meanwhile
+    is retried once on a new connection."""
+
+    handler_order = urllib2.HTTPHandler.handler_order - 1
+    connection_class = KeepAliveHTTPConnection
+
+    def __init__(self, pool=None, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool or default_pool
+
+    def http_open(self, req):
+        """Open a pooled connection for the given request"""
+        if req._tunnel_host:
+            return self.do_open(self.connection_class, req)  # proxy
+        return self.pooled_open(self.connection_class, req)
+
+    def pooled_open(self, http_class, req):
+        # Based on python 2.7's urllib2.AbstractHTTPHandler.do_open()
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (http_class, host)
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+        for retry in (True, False):
+            h, reused = self.pool.get(key,
+                lambda: http_class(host, timeout=req.timeout))
+            h.set_debuglevel(self._debuglevel)
+            try:
+                if reused:
+                    h.timeout = req.timeout
+                    if req.timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                        h.sock.settimeout(socket.getdefaulttimeout())
+                    else:
+                        h.sock.settimeout(req.timeout)
+                h.request(req.get_method(), req.get_selector(), req.data,
+                          headers)
+                r = h.getresponse(buffering=True)
+            except (socket.error, httplib.HTTPException), err:
+                self.pool.put(key, h, False)
+                if reused and retry:
+                    continue
+                raise urllib2.URLError(err)
+            except:
+                self.pool.put(key, h, False)
+                raise
+            break
+        def release(reuse):
+            self.pool.put(key, h, reuse)
+        r.release = release
+        if r.fp is None:
+            r.done(not r.will_close)  # no body at all
+        if r.status >= 400 and r.length is not None and r.length <= MAX_DRAIN:
+            # error pages are rarely read, don't hold the connection
+            # for them
+            fp = StringIO(r.read())
+        else:
+            r.recv = r.read
+            fp = socket._fileobject(r, close=True)
+        resp = urllib2.addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
 
 class StreamingHTTPRedirectHandler(urllib2.HTTPRedirectHandler):
     """Subclass of `urllib2.HTTPRedirectHandler` that overrides the
@@ -128,31 +467,112 @@ class StreamingHTTPRedirectHandler(urllib2.HTTPRedirectHandler):
         else:
             raise urllib2.HTTPError(req.get_full_url(), code, msg, headers, fp)
 
-class StreamingHTTPHandler(urllib2.HTTPHandler):
-    """Subclass of `urllib2.HTTPHandler` that uses
-    StreamingHTTPConnection as its http connection class."""
+class StreamingHTTPHandler(KeepAliveHandler):
+    """Subclass of `KeepAliveHandler` that uses
+    StreamingHTTPConnection as its http connection class.
 
-    handler_order = urllib2.HTTPHandler.handler_order - 1
+    If ``chunked`` is true, iterable bodies of unknown length are sent
+    with chunked transfer encoding."""
 
-    def http_open(self, req):
-        """Open a StreamingHTTPConnection for the given request"""
-        return self.do_open(StreamingHTTPConnection, req)
+    connection_class = StreamingHTTPConnection
+
+    def __init__(self, pool=None, debuglevel=0, chunked=False):
+        KeepAliveHandler.__init__(self, pool, debuglevel)
+        self.chunked = chunked
+        self.no_chunked = set()  # hosts that rejected a chunked request
 
     def http_request(self, req):
         """Handle a HTTP request.  Make sure that Content-Length is specified
-        if we're using an interable value"""
+        if we're using an interable value, or that it is sent chunked"""
         # Make sure that if we're using an iterable object as the request
         # body, that we've also specified Content-Length
         if req.has_data():
             data = req.get_data()
             if hasattr(data, 'read') or hasattr(data, 'next'):
                 if not req.has_header('Content-length'):
-                    raise ValueError(
+                    size = _file_size(data)
+                    if not self.chunked:
+                        raise ValueError(
                             "No Content-Length specified for iterable body")
+                    elif size is not None:
+                        req.add_unredirected_header('Content-length', size)
+                    elif req.get_host() in self.no_chunked:
+                        _spool_body(req)
+                    else:
+                        # keep do_request_() from taking len() of the body
+                        req.add_unredirected_header('Content-length', '')
+                        urllib2.HTTPHandler.do_request_(self, req)
+                        del req.unredirected_hdrs['Content-length']
+                        req.add_unredirected_header('Transfer-encoding',
+                                                    'chunked')
+                        return req
         return urllib2.HTTPHandler.do_request_(self, req)
 
-def streaming_opener():
-    handlers = [StreamingHTTPHandler, StreamingHTTPRedirectHandler]
+    def http_open(self, req):
+        """Open a StreamingHTTPConnection for the given request.
+
+        If the server rejects a chunked request (by its response, or by
+        closing the connection without one), the host is remembered
+        and the request is sent again with a Content-Length, if the body
+        can be rewound: it is read to a temporary file first."""
+        if req.get_header('Transfer-encoding') != 'chunked':
+            return KeepAliveHandler.http_open(self, req)
+        error = resp = None
+        try:
+            resp = KeepAliveHandler.http_open(self, req)
+            if resp.code not in CHUNKED_REJECTED:
+                return resp
+        except urllib2.URLError, e:
+            if not isinstance(e.reason, httplib.BadStatusLine) and \
+                    getattr(e.reason, 'errno', None) not in (errno.EPIPE,
+                                                             errno.ECONNRESET):
+                raise
+            error = e
+        self.no_chunked.add(req.get_host())
+        data = req.get_data()
+        try:
+            if hasattr(data, 'read'):
+                data.seek(0)
+            else:
+                data.reset()
+        except Exception:
+            # the body is gone, let the caller see what happened
+            if error is not None:
+                raise error
+            return resp
+        if resp is not None:
+            resp.close()
+        del req.unredirected_hdrs['Transfer-encoding']
+        _spool_body(req)
+        return KeepAliveHandler.http_open(self, req)
+
+def _file_size(data):
+    """Return the size of a file object as a string, or None"""
+    try:
+        return str(os.fstat(data.fileno()).st_size)
+    except (AttributeError, EnvironmentError):
+        return None
+
+def _spool_body(req):
+    """Read the body of a request to a temporary file, so that it is
+    sent with a Content-Length"""
+    data = req.get_data()
+    f = SpooledTemporaryFile(SPOOL_SIZE)
+    if hasattr(data, 'read'):
+        block = data.read(8192)
+        while block:
+            f.write(block)
+            block = data.read(8192)
+    else:
+        for block in data:
+            f.write(block)
+    req.add_unredirected_header('Content-length', str(f.tell()))
+    f.seek(0)
+    req.add_data(f)
+
+def streaming_opener(chunked=False):
+    handlers = [StreamingHTTPHandler(chunked=chunked),
+                StreamingHTTPRedirectHandler]
     opener = urllib2.build_opener(*handlers)
     return opener
 